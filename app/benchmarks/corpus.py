@@ -0,0 +1,77 @@
+import random
+
+# Словари для синтетических рабочих программ: термины предметной области и служебные слова заголовков
+RU_TERMS = [
+    'сеть', 'протокол', 'маршрутизация', 'алгоритм', 'граф', 'матрица', 'интеграл', 'производная', 'вероятность',
+    'статистика', 'регрессия', 'классификация', 'кластеризация', 'нейронный', 'оптимизация', 'компилятор',
+    'операционный', 'процесс', 'поток', 'память', 'кэш', 'транзакция', 'индекс', 'запрос', 'реляционный', 'шифрование',
+    'подпись', 'аутентификация', 'уязвимость', 'микроконтроллер', 'сигнал', 'фильтр', 'спектр', 'модуляция', 'антенна',
+    'термодинамика', 'энтропия', 'кинематика', 'динамика', 'механика', 'электричество', 'магнетизм', 'оптика',
+    'квантовый', 'полупроводник', 'лазер', 'экономика', 'рынок', 'спрос', 'предложение', 'инфляция', 'бюджет',
+    'маркетинг', 'менеджмент', 'проект', 'риск', 'качество', 'стандарт', 'документация', 'тестирование', 'интерфейс',
+    'архитектура', 'паттерн', 'объект', 'класс', 'наследование', 'функция', 'рекурсия', 'сортировка', 'поиск', 'дерево'
+]
+EN_TERMS = [
+    'network', 'protocol', 'routing', 'algorithm', 'graph', 'matrix', 'integral', 'derivative', 'probability',
+    'statistics', 'regression', 'classification', 'clustering', 'neural', 'optimization', 'compiler', 'operating',
+    'process', 'thread', 'memory', 'cache', 'transaction', 'index', 'query', 'relational', 'encryption', 'signature',
+    'authentication', 'vulnerability', 'microcontroller', 'signal', 'filter', 'spectrum', 'modulation', 'antenna',
+    'thermodynamics', 'entropy', 'kinematics', 'dynamics', 'mechanics', 'electricity', 'magnetism', 'optics',
+    'quantum', 'semiconductor', 'laser', 'economics', 'market', 'demand', 'supply', 'inflation', 'budget', 'marketing',
+    'management', 'project', 'risk', 'quality', 'standard', 'documentation', 'testing', 'interface', 'architecture',
+    'pattern', 'object', 'class', 'inheritance', 'function', 'recursion', 'sorting', 'search', 'tree'
+]
+RU_TEMPLATES = {
+    'title': ['Основы {0}', '{0} и {1}', 'Введение в {0}', 'Прикладной {0}'],
+    'description': ['Курс посвящён изучению {0}, {1} и {2}. Рассматриваются методы {3} и {4}.'],
+    'section': ['Раздел {n}. {0} и {1}', '{0}: {1}'],
+    'topic': ['{0} {1}', 'Методы {0} в задачах {1}', '{0}, {1} и {2}']
+}
+EN_TEMPLATES = {
+    'title': ['Fundamentals of {0}', '{0} and {1}', 'Introduction to {0}', 'Applied {0}'],
+    'description': ['The course covers {0}, {1} and {2}. Methods of {3} and {4} are discussed.'],
+    'section': ['Part {n}. {0} and {1}', '{0}: {1}'],
+    'topic': ['{0} {1}', '{0} methods for {1} problems', '{0}, {1} and {2}']
+}
+
+
+def _fill(rng, template, terms, n=0):
+    return template.format(*rng.sample(terms, 5), n=n)
+
+
+# Генератор строк в формате fetch_courses: (id, название, описание, [разделы], [темы]).
+# Генерирует курсы, пока общее число тем не достигнет topic_rows; lang — ru, en или mixed
+def generate_courses(topic_rows, lang='ru', seed=0, sections_per_course=(3, 8), topics_per_section=(2, 6)):
+    rng = random.Random(seed)
+    course_id = 0
+    emitted = 0
+    while emitted < topic_rows:
+        course_id += 1
+        course_lang = lang if lang != 'mixed' else rng.choice(['ru', 'en'])
+        terms, templates = (RU_TERMS, RU_TEMPLATES) if course_lang == 'ru' else (EN_TERMS, EN_TEMPLATES)
+        sections = []
+        topics = []
+        for n in range(1, rng.randint(*sections_per_course) + 1):
+            sections.append(_fill(rng, rng.choice(templates['section']), terms, n))
+            for _ in range(rng.randint(*topics_per_section)):
+                topics.append(_fill(rng, rng.choice(templates['topic']), terms))
+        topics = topics[:topic_rows - emitted]
+        emitted += len(topics)
+        yield (
+            course_id,
+            _fill(rng, rng.choice(templates['title']), terms),
+            _fill(rng, rng.choice(templates['description']), terms),
+            sections,
+            topics
+        )
+
+
+# Случайные наборы ключевых слов для запросов к /retrieve и /generate
+def generate_queries(count, lang='ru', seed=1, words=(2, 5)):
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        terms = RU_TERMS if lang == 'ru' or (lang == 'mixed' and rng.random() < 0.5) else EN_TERMS
+        keywords = rng.sample(terms, rng.randint(*words))
+        queries.append({'title': ' '.join(keywords[:2]).capitalize(), 'keywords': ', '.join(keywords)})
+    return queries
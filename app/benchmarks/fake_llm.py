@@ -0,0 +1,110 @@
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Локальная замена OpenAI chat completions API с настраиваемой задержкой ответа.
+# С rpm_limit / tpm_limit отвечает 429 с Retry-After при превышении лимитов; как у OpenAI,
+# лимиты восполняются непрерывно (limit / 60 единиц в секунду), начиная с полной минуты
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.5, response_tokens=200, rpm_limit=0, tpm_limit=0):
+        super().__init__((host, port), FakeLLMHandler)
+        self.latency = latency
+        self.response_tokens = response_tokens
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.requests = 0
+        self.rate_limited = 0
+        self._budget = {'requests': float(rpm_limit), 'tokens': float(tpm_limit)}
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # Списание запроса с лимитов; возвращает через сколько секунд повторить, если лимит превышен
+    def admit(self, tokens):
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            elapsed, self._updated = now - self._updated, now
+            waits = []
+            for name, limit, amount in (('requests', self.rpm_limit, 1), ('tokens', self.tpm_limit, tokens)):
+                if limit:
+                    self._budget[name] = min(limit, self._budget[name] + elapsed * limit / 60)
+                    waits.append((amount - self._budget[name]) * 60 / limit)
+            if waits and max(waits) > 0:
+                self.rate_limited += 1
+                return max(waits)
+            self._budget['requests'] -= 1
+            self._budget['tokens'] -= tokens
+            return None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt = payload['messages'][-1]['content']
+        words = [f"Тема {n + 1}." for n in range(self.server.response_tokens // 3)]
+        usage = {
+            'prompt_tokens': len(prompt) // 3,
+            'completion_tokens': self.server.response_tokens,
+            'total_tokens': len(prompt) // 3 + self.server.response_tokens
+        }
+        retry_after = self.server.admit(usage['total_tokens'])
+        if retry_after is not None:
+            body = b'{"error": {"message": "Rate limit reached", "type": "rate_limit_error"}}'
+            self.send_response(429)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Retry-After', str(math.ceil(retry_after)))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if payload.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            delay = self.server.latency / max(1, len(words))
+            for word in words:
+                time.sleep(delay)
+                chunk = {'choices': [{'delta': {'content': word + ' '}}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+
+        time.sleep(self.server.latency)
+        body = json.dumps({
+            'choices': [{'message': {'role': 'assistant', 'content': ' '.join(words)}}],
+            'usage': usage
+        }, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .corpus import generate_courses, generate_queries
+from .fake_llm import FakeLLMServer
+
+
+def max_rss_mb():
+    # ru_maxrss в Linux измеряется в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean_ms': 1000 * sum(ordered) / len(ordered),
+        'p50_ms': 1000 * pick(0.5),
+        'p90_ms': 1000 * pick(0.9),
+        'p99_ms': 1000 * pick(0.99),
+        'max_ms': 1000 * ordered[-1]
+    }
+
+
+# Параллельные запросы к приложению через тестовый клиент Flask
+def run_requests(app, path, payloads, concurrency):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def call(payload):
+        client = app.test_client()
+        started = time.perf_counter()
+        response = client.post(path, json=payload)
+        elapsed = time.perf_counter() - started
+        with lock:
+            if response.status_code == 200:
+                latencies.append(elapsed)
+            else:
+                errors.append(response.status_code)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, payloads))
+    wall = time.perf_counter() - started
+    result = percentiles(latencies)
+    result.update({'errors': len(errors), 'wall_s': wall, 'throughput_rps': len(payloads) / wall if wall else 0.0})
+    return result
+
+
+def benchmark(args, workdir):
+    # Окружение задаётся до импорта модулей приложения: они читают настройки при импорте
+    llm = FakeLLMServer(latency=args.llm_latency, response_tokens=args.response_tokens, rpm_limit=args.llm_rpm,
+                        tpm_limit=args.llm_tpm).start()
+    os.environ['RETRIEVER_BACKEND'] = 'tfidf'
+    os.environ['TFIDF_INDEX_PATH'] = os.path.join(workdir, 'tfidf_index')
+    os.environ['OPENAI_BASE_URL'] = llm.base_url
+    os.environ['LLM_CACHE_PATH'] = os.path.join(workdir, 'llm_cache.sqlite3')
+    os.environ.setdefault('API_KEY', 'benchmark')
+    # Планировщик получает те же лимиты, что и фиктивный провайдер
+    os.environ['LLM_RPM_LIMIT'] = str(args.llm_rpm)
+    os.environ['LLM_TPM_LIMIT'] = str(args.llm_tpm)
+
+    from modules.lemmatizer import lemma_cache
+    from modules.rag_system import index_stopwords, iter_courses, prepare_courses
+    from modules.retrievers import TfidfRetriever
+
+    results = {'memory': {'start_rss_mb': max_rss_mb()}}
+
+    started = time.perf_counter()
+    rows = generate_courses(args.topics, lang=args.lang, seed=args.seed)
+    prepared = prepare_courses(iter_courses(rows), workers=args.workers)
+    index_stats = TfidfRetriever.build(prepared, os.environ['TFIDF_INDEX_PATH'], stop_words=index_stopwords())
+    indexing_s = time.perf_counter() - started
+    results['indexing'] = {
+        'topic_rows': args.topics,
+        'courses': index_stats['documents'],
+        'terms': index_stats['terms'],
+        'seconds': indexing_s,
+        'courses_per_s': index_stats['documents'] / indexing_s,
+        'topic_rows_per_s': args.topics / indexing_s,
+        'lemma_cache': lemma_cache.stats()
+    }
+    results['memory']['after_indexing_rss_mb'] = max_rss_mb()
+
+    import main
+
+    queries = generate_queries(args.requests, lang=args.lang, seed=args.seed + 1)
+    results['retrieve'] = run_requests(main.app, '/retrieve', queries, args.concurrency)
+    results['memory']['after_retrieve_rss_mb'] = max_rss_mb()
+
+    generate_payloads = [dict(query, rag=True, cache=False) for query in queries[:args.generate_requests]]
+    results['generate'] = run_requests(main.app, '/generate', generate_payloads, args.concurrency)
+    results['generate']['llm_requests'] = llm.requests
+    results['generate']['llm_rate_limited'] = llm.rate_limited
+    results['memory']['after_generate_rss_mb'] = max_rss_mb()
+    llm.stop()
+    return results
+
+
+def compare(current, baseline):
+    rows = []
+    for section in ('indexing', 'retrieve', 'generate', 'memory'):
+        for key, value in current.get(section, {}).items():
+            base = baseline.get(section, {}).get(key)
+            if isinstance(value, (int, float)) and isinstance(base, (int, float)) and base:
+                rows.append(f"{section}.{key}: {base:.3f} -> {value:.3f} ({value / base:.2f}x)")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк индексации, /retrieve и /generate на синтетическом корпусе")
+    parser.add_argument('--topics', type=int, default=10000, help="число строк тем в синтетическом корпусе")
+    parser.add_argument('--lang', choices=['ru', 'en', 'mixed'], default='ru')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help="процессов для подготовки документов")
+    parser.add_argument('--requests', type=int, default=500, help="запросов к /retrieve")
+    parser.add_argument('--generate-requests', type=int, default=100, help="запросов к /generate")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="задержка фиктивного LLM, секунд")
+    parser.add_argument('--response-tokens', type=int, default=200)
+    parser.add_argument('--llm-rpm', type=int, default=0, help="лимит запросов в минуту фиктивного LLM (0 — без лимита)")
+    parser.add_argument('--llm-tpm', type=int, default=0, help="лимит токенов в минуту фиктивного LLM (0 — без лимита)")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="файл результатов предыдущего запуска для сравнения")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='rag-bench-') as workdir:
+        results = benchmark(args, workdir)
+    results['config'] = vars(args)
+    results['environment'] = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    print(json.dumps({key: results[key] for key in ('indexing', 'retrieve', 'generate', 'memory')},
+                     ensure_ascii=False, indent=2))
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        print('\n'.join(compare(results, baseline)))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,33 @@
+import multiprocessing
+import os
+
+# Продакшн-запуск: gunicorn -c gunicorn.conf.py main:app
+bind = os.getenv('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count()))
+# gevent-воркеры: ожидание ответов Elasticsearch и LLM не занимает поток ОС,
+# поэтому один воркер держит сотни одновременных запросов
+worker_class = os.getenv('WEB_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('WEB_WORKER_CONNECTIONS', 1000))
+# Генерация длится дольше стандартных 30 секунд
+timeout = int(os.getenv('WEB_TIMEOUT', 300))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+preload_app = os.getenv('WEB_PRELOAD', '0') == '1'
+accesslog = '-'
+
+# С preload приложение импортируется в мастере, до того как воркер пропатчит stdlib: патчим заранее
+if preload_app and worker_class == 'gevent':
+    from gevent import monkey
+
+    monkey.patch_all()
+
+
+# Клиенты Elasticsearch, LLM и SQLite-кэша создаются в каждом воркере заново, а не наследуются от мастера.
+# Хук выполняется после monkey-patching gevent: импорт requests/urllib3 до него оставляет непропатченный ssl,
+# и HTTPS-запросы к LLM падают с RecursionError
+def post_worker_init(worker):
+    from modules.rag_system import llm_scheduler, reset_clients
+
+    reset_clients()
+    # Лимиты LLM_RPM_LIMIT и LLM_TPM_LIMIT общие для всех воркеров: каждый получает свою долю
+    llm_scheduler.set_shards(worker.cfg.workers)
@@ -1,9 +1,41 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 import os
 import json
-from modules.data_retrieval import get_db_data, do_stuff
+import time
+from modules.data_retrieval import BATCH_CONCURRENCY, get_db_data, do_stuff, stream_stuff, do_batch, iter_batch, \
+    do_compare, validate_batch
+from modules.lemmatizer import lemma_cache
+from modules.llm_cache import completion_cache
+from modules.llm_client import LLMError
+from modules.metrics import cache_stats as cache_gauge, collectors, render, request_duration, request_stages, \
+    requests_total, start_request
+from modules.prompting import few_shot_store
+from modules.rag_system import retrieval_cache
+from modules.results_store import result_store
 
 app = Flask(__name__)
+# Индекс примеров few-shot строится при старте, а не на первом запросе
+few_shot_store.build()
+
+@app.before_request
+def before_request():
+    g.started = time.perf_counter()
+    start_request()
+
+@app.after_request
+def after_request(response):
+    endpoint = request.endpoint or 'unknown'
+    requests_total.inc(endpoint=endpoint, status=response.status_code)
+    request_duration.observe(time.perf_counter() - g.started, endpoint=endpoint)
+    return response
+
+def collect_cache_stats():
+    for name, cache in (('retrieval', retrieval_cache), ('lemma', lemma_cache), ('completion', completion_cache)):
+        for field, value in cache.stats().items():
+            if isinstance(value, (int, float)):
+                cache_gauge.set(value, cache=name, field=field)
+
+collectors.append(collect_cache_stats)
 
 @app.route('/retrieve', methods=['POST'])
 def retrieve():
@@ -11,24 +43,15 @@ def retrieve():
     debug = data.get('debug', False)
     write_to_file = data.get('write_to_file', False)
     result = get_db_data(data['title'], data['keywords'], debug)
+    if debug:
+        result['stages'] = request_stages()
 
+    # Результат сохраняется в фоне; в ответе вместо пути к файлу — идентификатор записи для /results/<id>
     if write_to_file:
-        directory = 'retrieved'
-        base_path = os.path.abspath(os.path.dirname(__file__))
-        new_folder_path = os.path.join(base_path, directory)
-        if not os.path.exists(new_folder_path):
-            os.makedirs(new_folder_path)
-        filename = f"{data['title'].replace(' ', '_')}.json"
-        full_path = os.path.join(new_folder_path, filename)
-        try:
-            with open(full_path, 'w') as file:
-                json.dump(result['retrieved_data'], file, indent=4)
-            return jsonify({
-                'data': result['retrieved_data'],
-                'path': full_path
-            })
-        except IOError as e:
-            return jsonify({'error': 'Failed to write file'}), 500
+        return jsonify({
+            'data': result['retrieved_data'],
+            'id': result_store.put('retrieve', {'request': data, 'result': result})
+        })
 
     return jsonify(result)
 
@@ -42,9 +65,114 @@ def generate():
         data.get('level', ''),
         data.get('hours', ''),
         data.get('rag', False),
-        data.get('debug', False)
+        data.get('debug', False),
+        data.get('cache', True)
+    )
+    if data.get('debug', False):
+        result['stages'] = request_stages()
+    if data.get('write_to_file', False):
+        result['id'] = result_store.put('generate', {'request': data, 'result': dict(result)})
+    return jsonify(result)
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    data = request.json
+    events = stream_stuff(
+        data.get('approach', 'zero-shot'),
+        data['title'],
+        data['keywords'],
+        data.get('level', ''),
+        data.get('hours', ''),
+        data.get('rag', False),
+        data.get('debug', False),
+        data.get('cache', True)
+    )
+
+    def stream():
+        try:
+            for event, payload in events:
+                yield sse_event(event, payload)
+        except LLMError as e:
+            yield sse_event('error', {'error': str(e)})
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
     )
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    data = request.json
+    items = data.get('items')
+    debug = data.get('debug', False)
+    use_cache = data.get('cache', True)
+    try:
+        validate_batch(items)
+        concurrency = int(data.get('concurrency', BATCH_CONCURRENCY))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    # С stream=true результаты отдаются NDJSON-строками по мере готовности
+    if data.get('stream', False):
+        def stream():
+            for position, result in iter_batch(items, debug, use_cache, concurrency):
+                yield json.dumps({'index': position, 'result': result}, ensure_ascii=False) + '\n'
+
+        return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+
+    result = {'results': do_batch(items, debug, use_cache, concurrency)}
+    if debug:
+        result['stages'] = request_stages()
     return jsonify(result)
 
+@app.route('/generate/compare', methods=['POST'])
+def generate_compare():
+    data = request.json
+    result = do_compare(
+        data['title'],
+        data['keywords'],
+        data.get('level', ''),
+        data.get('hours', ''),
+        data.get('approaches'),
+        data.get('rag_modes', [True, False]),
+        data.get('debug', False),
+        data.get('cache', True)
+    )
+    if data.get('debug', False):
+        result['stages'] = request_stages()
+    return jsonify(result)
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'retrieval': retrieval_cache.stats(),
+        'lemma': lemma_cache.stats(),
+        'completion': completion_cache.stats()
+    })
+
+@app.route('/results', methods=['GET'])
+def list_results():
+    return jsonify({'results': result_store.list(
+        request.args.get('limit', 50, type=int),
+        request.args.get('offset', 0, type=int),
+        request.args.get('kind')
+    )})
+
+@app.route('/results/<record_id>', methods=['GET'])
+def get_result(record_id):
+    record = result_store.get(record_id)
+    if record is None:
+        return jsonify({'error': 'Result not found'}), 404
+    return jsonify(record)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Отладочный сервер для разработки; в продакшне: gunicorn -c gunicorn.conf.py main:app
+    app.run(debug=os.getenv('FLASK_DEBUG', '0') == '1', host='0.0.0.0', port=5000)
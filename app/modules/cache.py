@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL')
+
+
+# Локальный LRU-кэш с ограничением времени жизни записей
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'backend': 'memory',
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+# Общий для нескольких процессов кэш в Redis (нужен пакет redis)
+class RedisCache:
+    def __init__(self, url, prefix, ttl):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self.client.get(f"{self.prefix}:{key}")
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(f"{self.prefix}:{key}", json.dumps(value, ensure_ascii=False), ex=int(self.ttl))
+
+    def clear(self):
+        # Записи старых поколений индекса недостижимы по ключу и истекают по TTL
+        pass
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'backend': 'redis',
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+def make_cache(prefix, maxsize, ttl):
+    if CACHE_REDIS_URL:
+        return RedisCache(CACHE_REDIS_URL, prefix, ttl)
+    return TTLCache(maxsize, ttl)
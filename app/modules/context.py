@@ -0,0 +1,97 @@
+import math
+import os
+import re
+
+from .lemmatizer import lemmatize_text
+
+# Сколько лучших курсов участвуют в контексте и сколько токенов он может занять
+RAG_TOP_K = int(os.getenv('RAG_TOP_K', 3))
+RAG_TOKEN_BUDGET = int(os.getenv('RAG_TOKEN_BUDGET', 1500))
+# Порог сходства Жаккара по леммам, начиная с которого фрагменты считаются дубликатами
+RAG_DEDUP_THRESHOLD = float(os.getenv('RAG_DEDUP_THRESHOLD', 0.8))
+
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+WORD_RE = re.compile(r"\w+")
+
+
+# Быстрая локальная оценка числа токенов BPE-токенизатора: короткие слова и знаки — по токену,
+# длинные латинские слова — примерно по 4 символа на токен, кириллические — по 3
+def estimate_tokens(text):
+    count = 0
+    for token in TOKEN_RE.findall(text or ''):
+        if len(token) <= 4:
+            count += 1
+        else:
+            count += math.ceil(len(token) / (4 if token.isascii() else 3))
+    return count
+
+
+# Множество лемм фрагмента; слова выделяются до лемматизации, чтобы знаки препинания не попадали в леммы
+def _lemma_set(text):
+    return frozenset(lemmatize_text(' '.join(WORD_RE.findall(text.lower()))).split())
+
+
+def _is_duplicate(lemmas, kept):
+    if not lemmas:
+        return True
+    for other in kept:
+        union = len(lemmas | other)
+        if union and len(lemmas & other) / union >= RAG_DEDUP_THRESHOLD:
+            return True
+    return False
+
+
+# Сборка контекста из top_k найденных курсов: разделы и темы ранжируются по оценке курса,
+# почти одинаковые фрагменты отбрасываются, остальные укладываются в бюджет токенов
+def assemble_context(hits, top_k=RAG_TOP_K, token_budget=RAG_TOKEN_BUDGET):
+    hits = hits[:top_k]
+    snippets = []
+    for rank, hit in enumerate(hits):
+        for kind in ('sections', 'topics'):
+            for text in hit[kind]:
+                if text:
+                    snippets.append((-hit['score'], rank, kind, text))
+    snippets.sort(key=lambda snippet: (snippet[0], snippet[1], snippet[2] == 'topics'))
+
+    selected = {'sections': [], 'topics': []}
+    kept_lemmas = []
+    tokens_used = 0
+    dropped_duplicates = 0
+    dropped_budget = 0
+    # +1 за разделитель между фрагментами
+    costs = [estimate_tokens(text) + 1 for _, _, _, text in snippets]
+    # Самый дешёвый из оставшихся фрагментов: когда не влезает и он, просмотр заканчивается
+    cheapest = costs[:]
+    for position in range(len(cheapest) - 2, -1, -1):
+        cheapest[position] = min(cheapest[position], cheapest[position + 1])
+    for position, (_, _, kind, text) in enumerate(snippets):
+        if tokens_used + cheapest[position] > token_budget:
+            dropped_budget += len(snippets) - position
+            break
+        # Бюджет проверяется до лемматизации: сравнение с уже выбранными фрагментами — самая дорогая часть
+        cost = costs[position]
+        if tokens_used + cost > token_budget:
+            dropped_budget += 1
+            continue
+        lemmas = _lemma_set(text)
+        if _is_duplicate(lemmas, kept_lemmas):
+            dropped_duplicates += 1
+            continue
+        selected[kind].append(text)
+        kept_lemmas.append(lemmas)
+        tokens_used += cost
+
+    # Пустой контекст, если в бюджет не попал ни один фрагмент, иначе в промпт ушло бы «. »
+    text = '. '.join(', '.join(selected[kind]) for kind in ('sections', 'topics') if selected[kind])
+    return {
+        'text': text,
+        'explanation': hits[0]['explanation'] if hits else "",
+        'budget': {
+            'courses': len(hits),
+            'token_budget': token_budget,
+            'tokens_used': tokens_used,
+            'snippets': len(selected['sections']) + len(selected['topics']),
+            'dropped_duplicates': dropped_duplicates,
+            'dropped_budget': dropped_budget
+        }
+    }
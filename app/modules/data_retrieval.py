@@ -1,28 +1,234 @@
-from .rag_system import rag_system, generate_text_with_chatgpt, lemmatize_text
-from .prompting import prompt_creator
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .rag_system import (rag_system, rag_system_many, generate_text_with_chatgpt, stream_text_with_chatgpt,
+                         lemmatize_text, lemmatize_texts)
+from .context import estimate_tokens
+from .prompting import APPROACHES, prompt_creator, template_version
+from .llm_client import LLMError
+from .llm_scheduler import priority
+from .metrics import prompt_chars, record_stage, request_stages, response_chars, timed
+from .singleflight import SingleFlight
+
+# Сколько LLM-запросов пакетной генерации выполняется одновременно
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+
+generate_flight = SingleFlight('generate')
 
 
 def get_db_data(title, keywords, debug):
-    user_query_lemmatized = lemmatize_text(keywords)
+    with timed('lemmatize'):
+        user_query_lemmatized = lemmatize_text(keywords)
     retrieved_data = rag_system(user_query_lemmatized)
+    return _db_result(keywords, retrieved_data, debug)
+
+
+# Пакетный вариант get_db_data: все запросы уходят в Elasticsearch одним msearch
+def get_db_data_many(keywords_list, debug):
+    with timed('lemmatize'):
+        lemmatized = lemmatize_texts(keywords_list)
+    retrieved = rag_system_many(lemmatized)
+    return [_db_result(keywords, retrieved_data, debug) for keywords, retrieved_data in zip(keywords_list, retrieved)]
+
+
+def _db_result(keywords, retrieved_data, debug):
     result = {'user_query': keywords, 'retrieved_data': retrieved_data['text']}
     if debug:
         result['explanation'] = retrieved_data['explanation']
+        result['context_budget'] = retrieved_data['budget']
     return result
 
 
-def do_stuff(approach, title, keywords, level, hours, rag, debug):
-    retrieved_data = get_db_data(title, keywords, debug)
+def make_prompt(retrieved_data, approach, title, keywords, level, hours, rag):
     context = f"«{retrieved_data['retrieved_data']}»" if retrieved_data['retrieved_data'] else ''
-    prompt = prompt_creator(approach, context, title, keywords, level, hours, rag)
-    generated_data = generate_text_with_chatgpt(prompt)
+    with timed('prompt'):
+        prompt = prompt_creator(approach, context, title, keywords, level, hours, rag)
+    prompt_chars.observe(len(prompt))
+    return prompt
+
+
+def build_prompt(approach, title, keywords, level, hours, rag, debug):
+    retrieved_data = get_db_data(title, keywords, debug)
+    prompt = make_prompt(retrieved_data, approach, title, keywords, level, hours, rag)
+    return retrieved_data, prompt
+
+
+def generate_from_retrieved(retrieved_data, approach, title, keywords, level, hours, rag, debug, use_cache=True):
+    prompt = make_prompt(retrieved_data, approach, title, keywords, level, hours, rag)
+    with timed('llm'):
+        generated_data, cached = generate_text_with_chatgpt(prompt, use_cache)
+    response_chars.observe(len(generated_data))
     result = {
         'approach': approach,
         'user_query': title + ", " + keywords,
         'retrieved_data': retrieved_data['retrieved_data'],
-        'generated_data': generated_data
+        'generated_data': generated_data,
+        'prompt_version': template_version(approach, level),
+        'cached': cached
+    }
+    if debug:
+        result['prompt'] = prompt
+        result['explanation'] = retrieved_data['explanation']
+        result['context_budget'] = retrieved_data['context_budget']
+    return result
+
+
+def _normalize(value):
+    return ' '.join(str(value).split()) if value is not None else ''
+
+
+# Одинаковые одновременные запросы (повторная отправка формы, всплеск запросов по одной дисциплине)
+# разделяют один поиск и один вызов LLM; каждый получает свою копию результата
+def do_stuff(approach, title, keywords, level, hours, rag, debug, use_cache=True):
+    key = (approach, _normalize(title), _normalize(keywords), _normalize(level), _normalize(hours), bool(rag),
+           bool(debug), bool(use_cache))
+    return dict(generate_flight.do(key, _do_stuff, approach, title, keywords, level, hours, rag, debug, use_cache))
+
+
+def _do_stuff(approach, title, keywords, level, hours, rag, debug, use_cache):
+    retrieved_data = get_db_data(title, keywords, debug)
+    return generate_from_retrieved(retrieved_data, approach, title, keywords, level, hours, rag, debug, use_cache)
+
+
+# Потоковый вариант do_stuff: генератор событий (тип, данные) — meta, затем token по мере генерации, затем done
+def stream_stuff(approach, title, keywords, level, hours, rag, debug, use_cache=True):
+    retrieved_data, prompt = build_prompt(approach, title, keywords, level, hours, rag, debug)
+    chunks, cached = stream_text_with_chatgpt(prompt, use_cache)
+    meta = {
+        'approach': approach,
+        'user_query': title + ", " + keywords,
+        'retrieved_data': retrieved_data['retrieved_data'],
+        'prompt_version': template_version(approach, level),
+        'cached': cached
     }
+    if debug:
+        meta['prompt'] = prompt
+        meta['explanation'] = retrieved_data['explanation']
+        meta['context_budget'] = retrieved_data['context_budget']
+    yield 'meta', meta
+    # Время генерации считается без пауз на отправку фрагментов клиенту
+    llm_seconds = 0.0
+    response_size = 0
+    started = time.perf_counter()
+    for chunk in chunks:
+        llm_seconds += time.perf_counter() - started
+        response_size += len(chunk)
+        yield 'token', {'text': chunk}
+        started = time.perf_counter()
+    llm_seconds += time.perf_counter() - started
+    record_stage('llm', llm_seconds)
+    response_chars.observe(response_size)
+    yield 'done', {'stages': request_stages()} if debug else {}
+
+
+# Пакетные задания идут в LLM с низким приоритетом и не задерживают интерактивные запросы
+def _generate_batch_item(item, retrieved_data, debug, use_cache):
+    try:
+        with priority('bulk'):
+            return generate_from_retrieved(
+                retrieved_data,
+                item.get('approach', 'zero-shot'),
+                item['title'],
+                item['keywords'],
+                item.get('level', ''),
+                item.get('hours', ''),
+                item.get('rag', False),
+                debug,
+                use_cache
+            )
+    except (LLMError, ValueError) as e:
+        return {'user_query': item['title'] + ", " + item['keywords'], 'error': str(e)}
+
+
+# Проверка элементов пакета до начала работы: ошибка в одном элементе не должна обрывать весь пакет
+def validate_batch(items):
+    if not isinstance(items, list):
+        raise ValueError("items must be a list")
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"items[{position}] must be an object")
+        for field in ('title', 'keywords'):
+            if not isinstance(item.get(field), str) or not item[field]:
+                raise ValueError(f"items[{position}].{field} must be a non-empty string")
+        if item.get('approach', 'zero-shot') not in APPROACHES:
+            raise ValueError(f"items[{position}].approach is not supported: {item['approach']}")
+
+
+# Пакетная генерация: генератор пар (позиция элемента, результат) в порядке готовности.
+# items — список словарей с полями title, keywords и необязательными approach, level, hours, rag
+def iter_batch(items, debug=False, use_cache=True, concurrency=BATCH_CONCURRENCY):
+    # Клиент может уменьшить параллелизм, но не превысить BATCH_CONCURRENCY
+    concurrency = min(max(1, concurrency), BATCH_CONCURRENCY)
+    retrieved = get_db_data_many([item['keywords'] for item in items], debug)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            # Копия контекста передаёт потоку разбивку по этапам текущего запроса
+            executor.submit(contextvars.copy_context().run, _generate_batch_item, item, retrieved_data, debug,
+                            use_cache): position
+            for position, (item, retrieved_data) in enumerate(zip(items, retrieved))
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# Пакетная генерация с результатами в исходном порядке
+def do_batch(items, debug=False, use_cache=True, concurrency=BATCH_CONCURRENCY):
+    results = [None] * len(items)
+    for position, result in iter_batch(items, debug, use_cache, concurrency):
+        results[position] = result
+    return results
+
+
+def _compare_variant(retrieved_data, approach, rag, title, keywords, level, hours, debug, use_cache):
+    result = {'approach': approach, 'rag': rag}
+    try:
+        prompt = make_prompt(retrieved_data, approach, title, keywords, level, hours, rag)
+        started = time.perf_counter()
+        with timed('llm'):
+            generated_data, cached = generate_text_with_chatgpt(prompt, use_cache)
+        result['latency'] = time.perf_counter() - started
+    except (LLMError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+    response_chars.observe(len(generated_data))
+    result.update({
+        'generated_data': generated_data,
+        'cached': cached,
+        'prompt_version': template_version(approach, level),
+        'prompt_chars': len(prompt),
+        'prompt_tokens': estimate_tokens(prompt)
+    })
     if debug:
         result['prompt'] = prompt
+    return result
+
+
+# Сравнение подходов: контекст ищется один раз, промпты для всех пар (подход, rag) отправляются в LLM
+# одновременно, так что сравнение длится примерно столько же, сколько самая долгая генерация
+def do_compare(title, keywords, level='', hours='', approaches=None, rag_modes=(True, False), debug=False,
+               use_cache=True):
+    approaches = approaches or list(APPROACHES)
+    variants = [(approach, rag) for approach in approaches for rag in rag_modes]
+    started = time.perf_counter()
+    retrieved_data = get_db_data(title, keywords, debug)
+    retrieval_latency = time.perf_counter() - started
+    with ThreadPoolExecutor(max_workers=max(1, len(variants))) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, _compare_variant, retrieved_data, approach, rag, title,
+                            keywords, level, hours, debug, use_cache)
+            for approach, rag in variants
+        ]
+        results = [future.result() for future in futures]
+    result = {
+        'user_query': title + ", " + keywords,
+        'retrieved_data': retrieved_data['retrieved_data'],
+        'retrieval_latency': retrieval_latency,
+        'latency': time.perf_counter() - started,
+        'variants': results
+    }
+    if debug:
         result['explanation'] = retrieved_data['explanation']
+        result['context_budget'] = retrieved_data['context_budget']
     return result
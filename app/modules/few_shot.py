@@ -0,0 +1,80 @@
+import os
+import threading
+
+import numpy as np
+from scipy import sparse
+
+from .lemmatizer import lemmatize_text, lemmatize_texts
+from .retrievers import TOKEN_PATTERN
+
+# Сколько похожих дисциплин подставляется в few-shot, если точного совпадения названия нет,
+# и минимальное косинусное сходство, ниже которого примеры не используются
+FEW_SHOT_K = int(os.getenv('FEW_SHOT_K', 3))
+FEW_SHOT_MIN_SCORE = float(os.getenv('FEW_SHOT_MIN_SCORE', 0.1))
+# Вес названия относительно списка разделов примера
+TITLE_WEIGHT = 2
+
+
+def _normalize_rows(matrix):
+    norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A.ravel()
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms) @ matrix, dtype=np.float32)
+
+
+# Индекс примеров few-shot: названия и разделы лемматизируются так же, как при поиске курсов,
+# и хранятся в одной нормированной TF-IDF матрице. Соседи находятся одним разреженным произведением
+# и argpartition, без перебора примеров в Python. Строится при старте приложения или при первом обращении
+class FewShotStore:
+    def __init__(self, examples, k=FEW_SHOT_K, min_score=FEW_SHOT_MIN_SCORE):
+        self.examples = examples
+        self.k = k
+        self.min_score = min_score
+        self._titles = list(examples)
+        self._vectorizer = None
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    def build(self):
+        if self._matrix is not None:
+            return
+        with self._lock:
+            if self._matrix is not None:
+                return
+            from sklearn.feature_extraction.text import TfidfVectorizer
+
+            titles = lemmatize_texts([title.lower() for title in self._titles])
+            sections = lemmatize_texts([' '.join(self.examples[title]).lower() for title in self._titles])
+            vectorizer = TfidfVectorizer(token_pattern=TOKEN_PATTERN.pattern)
+            vectorizer.fit(titles + sections)
+            matrix = vectorizer.transform(titles) * TITLE_WEIGHT + vectorizer.transform(sections)
+            self._vectorizer = vectorizer
+            self._matrix = _normalize_rows(matrix)
+
+    # Названия k ближайших примеров с косинусным сходством не ниже min_score, по убыванию сходства
+    def nearest(self, title, k=None):
+        k = self.k if k is None else k
+        if not self._titles or k <= 0:
+            return []
+        self.build()
+        query = self._vectorizer.transform([lemmatize_text(title.lower())])
+        scores = (self._matrix @ query.T).toarray().ravel()
+        count = min(k, int(np.count_nonzero(scores >= self.min_score)))
+        if count == 0:
+            return []
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        return [(self._titles[position], float(scores[position])) for position in top]
+
+    # Текст few-shot инструкции: примеры самой дисциплины, если они есть, иначе разделы похожих дисциплин
+    def prompt(self, title):
+        if title in self.examples:
+            examples_text = "\n\n".join([f"Пример {i + 1}:\n{example}" for i, example in enumerate(self.examples[title])])
+            return f"Для лучшего понимания структуры, включи в запрос следующие примеры:\n{examples_text}"
+        neighbours = self.nearest(title) if title else []
+        if not neighbours:
+            return ""
+        examples_text = "\n\n".join([
+            f"Пример {i + 1} — «{neighbour}»:\n" + "\n".join(self.examples[neighbour])
+            for i, (neighbour, _) in enumerate(neighbours)
+        ])
+        return f"Для лучшего понимания структуры, включи в запрос следующие примеры похожих дисциплин:\n{examples_text}"
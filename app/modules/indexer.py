@@ -0,0 +1,93 @@
+import argparse
+import json
+import time
+
+from .lemmatizer import lemma_cache
+from .metrics import render, stage_duration
+from .rag_system import INDEX_CHUNK_SIZE, INDEX_WORKERS, RETRIEVER_BACKEND, build_tfidf_index, measure_index, \
+    sync_courses
+
+
+# Вывод хода индексации с пропускной способностью этапа
+class ProgressReporter:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.stage_started = {}
+
+    def __call__(self, stage, count):
+        now = time.monotonic()
+        # Этап начинается там, где закончился предыдущий
+        stage_started = self.stage_started.setdefault(stage, self.last_report)
+        self.last_report = now
+        elapsed = now - stage_started
+        rate = f", {count / elapsed:.1f}/s" if elapsed > 0 else ""
+        print(f"[{now - self.started:7.1f}s] {stage}: {count}{rate}", flush=True)
+
+
+# Замер текущего индекса Elasticsearch без синхронизации; с compare — сравнение с прошлым замером.
+# Запросы сохраняются в measure_file и повторяются при сравнении, чтобы задержки мерились на одном наборе
+def measure(args):
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+    result = measure_index(sample=args.sample, queries=baseline.get('sample_queries') if baseline else None)
+    print(json.dumps({key: value for key, value in result.items() if key != 'sample_queries'},
+                     ensure_ascii=False, indent=2))
+    if args.measure_file:
+        with open(args.measure_file, 'w', encoding='utf-8') as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+    if baseline:
+        for key in ('store_bytes', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms'):
+            if baseline.get(key):
+                print(f"{key}: {baseline[key]:.1f} -> {result[key]:.1f} ({result[key] / baseline[key]:.2f}x)")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Индексация курсов из PostgreSQL в Elasticsearch или TF-IDF индекс")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--full', action='store_true',
+                      help="перестроить индекс целиком и переключить алиас")
+    mode.add_argument('--incremental', action='store_true',
+                      help="обновить только изменившиеся курсы (по умолчанию)")
+    parser.add_argument('--backend', choices=['elasticsearch', 'tfidf'], default=RETRIEVER_BACKEND,
+                        help="куда индексировать: Elasticsearch или TF-IDF матрица на диске (всегда целиком)")
+    parser.add_argument('--workers', type=int, default=INDEX_WORKERS,
+                        help="число процессов для лемматизации документов")
+    parser.add_argument('--chunk-size', type=int, default=INDEX_CHUNK_SIZE,
+                        help="курсов в одной порции задания для процесса")
+    parser.add_argument('--metrics-file',
+                        help="записать метрики в формате Prometheus (для textfile collector node_exporter)")
+    parser.add_argument('--measure', action='store_true',
+                        help="не индексировать, а замерить размер индекса и задержку поиска (INDEX_PROFILE, ES_MORPHOLOGY)")
+    parser.add_argument('--sample', type=int, default=200, help="число запросов для замера")
+    parser.add_argument('--measure-file', help="сохранить результат замера в JSON")
+    parser.add_argument('--compare', help="файл предыдущего замера для сравнения")
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        return measure(args)
+
+    progress = ProgressReporter()
+    if args.backend == 'tfidf':
+        stats = build_tfidf_index(progress=progress, workers=args.workers, chunk_size=args.chunk_size)
+    else:
+        stats = sync_courses(full=args.full, progress=progress, workers=args.workers, chunk_size=args.chunk_size)
+    elapsed = time.monotonic() - progress.started
+    if stats is None:
+        print("No courses fetched, index left unchanged.")
+        return 1
+    print(f"Courses indexed successfully in {elapsed:.1f}s: {stats}")
+    print(f"Lemma cache: {lemma_cache.stats()}")
+    for (stage,), seconds in sorted(stage_duration.sums().items()):
+        print(f"  {stage}: {seconds:.2f}s")
+    if args.metrics_file:
+        with open(args.metrics_file, 'w', encoding='utf-8') as file:
+            file.write(render())
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,148 @@
+import atexit
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pymorphy2
+
+LEMMA_CACHE_SIZE = int(os.getenv('LEMMA_CACHE_SIZE', 200000))
+LEMMA_CACHE_PATH = os.getenv('LEMMA_CACHE_PATH')
+
+# Словари pymorphy2 загружаются при первой лемматизации, а не при импорте
+_morph = None
+_morph_lock = threading.Lock()
+
+
+def get_morph():
+    global _morph
+    if _morph is None:
+        with _morph_lock:
+            if _morph is None:
+                _morph = pymorphy2.MorphAnalyzer()
+    return _morph
+
+
+# Ограниченный LRU-кэш лемм: слово -> нормальная форма
+class LemmaCache:
+    def __init__(self, maxsize=LEMMA_CACHE_SIZE, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # Новые леммы с момента включения учёта (в процессах пула индексации), None — учёт выключен
+        self._added = None
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def get(self, word):
+        with self._lock:
+            lemma = self._data.get(word)
+            if lemma is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(word)
+            self.hits += 1
+            return lemma
+
+    def put(self, word, lemma):
+        with self._lock:
+            self._data[word] = lemma
+            self._data.move_to_end(word)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            if self._added is not None:
+                self._added[word] = lemma
+
+    def update(self, items):
+        for word, lemma in items:
+            self.put(word, lemma)
+
+    # Учёт новых лемм: процесс пула возвращает их родителю вместе с результатом, иначе они пропадут вместе с процессом
+    def track_added(self):
+        with self._lock:
+            self._added = {}
+
+    def take_added(self):
+        with self._lock:
+            added = list(self._added.items()) if self._added else []
+            if self._added is not None:
+                self._added = {}
+            return added
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+    def load(self, path=None):
+        path = path or self.path
+        # Повреждённый или недоступный кэш не должен мешать запуску: начинаем с пустого
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                items = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Failed to load lemma cache from {path}: {e}", flush=True)
+            return
+        with self._lock:
+            for word, lemma in items[-self.maxsize:]:
+                self._data[word] = lemma
+
+    def save(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            items = list(self._data.items())
+        # Запись через временный файл, чтобы не оставить на диске обрезанный кэш; у каждого процесса свой
+        # временный файл — воркеры gunicorn сохраняют кэш одновременно при остановке
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(items, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+lemma_cache = LemmaCache(path=LEMMA_CACHE_PATH)
+if LEMMA_CACHE_PATH:
+    atexit.register(lemma_cache.save)
+
+
+def lemmatize_word(word):
+    lemma = lemma_cache.get(word)
+    if lemma is None:
+        lemma = get_morph().parse(word)[0].normal_form
+        lemma_cache.put(word, lemma)
+    return lemma
+
+
+def lemmatize_text(text):
+    if text is None:
+        return ""
+    words = text.split()  # Разбиение текста на слова
+    lemmatized_words = [lemmatize_word(word) for word in words]
+    return ' '.join(lemmatized_words)  # Соединение слов обратно в строку
+
+
+# Пакетная лемматизация: каждая уникальная строка обрабатывается один раз
+def lemmatize_texts(texts):
+    seen = {}
+    result = []
+    for text in texts:
+        if text not in seen:
+            seen[text] = lemmatize_text(text)
+        result.append(seen[text])
+    return result
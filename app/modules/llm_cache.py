@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+LLM_CACHE_PATH = os.getenv(
+    'LLM_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'llm_cache.sqlite3')
+)
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', 100 * 1024 * 1024))
+# Сколько самых давно использованных записей удаляется за один шаг вытеснения
+EVICT_BATCH = 10
+
+
+# Кэш ответов LLM в SQLite с адресацией по содержимому запроса
+class CompletionCache:
+    def __init__(self, path=LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    # Соединение открывается при первом обращении, чтобы каждый процесс получал своё
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            # WAL без fsync на каждый commit: запись в кэш не блокирует обработку запросов
+            self._conn.execute("pragma journal_mode=wal")
+            self._conn.execute("pragma synchronous=normal")
+            self._conn.execute(
+                "create table if not exists completions ("
+                "key text primary key, model text, temperature real, response text, "
+                "size integer, created_at real, accessed_at real)"
+            )
+            self._conn.execute("create index if not exists completions_accessed_at on completions (accessed_at)")
+            self._conn.commit()
+        return self._conn
+
+    # Закрытие соединения; следующее обращение откроет новое (нужно после fork)
+    def reset(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def make_key(model, temperature, prompt):
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return hashlib.sha256(json.dumps([model, temperature, prompt_hash]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("select response from completions where key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("update completions set accessed_at = ? where key = ?", (time.time(), key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, model, temperature, response):
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "insert or replace into completions values (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, temperature, response, size, now, now)
+            )
+            self._evict(conn)
+            conn.commit()
+
+    # Вытеснение давно не использованных ответов, пока общий размер превышает лимит
+    def _evict(self, conn):
+        while conn.execute("select coalesce(sum(size), 0) from completions").fetchone()[0] > self.max_bytes:
+            conn.execute(
+                "delete from completions where key in "
+                "(select key from completions order by accessed_at limit ?)",
+                (EVICT_BATCH,)
+            )
+
+    def stats(self):
+        with self._lock:
+            count, size = self._connection().execute(
+                "select count(*), coalesce(sum(size), 0) from completions"
+            ).fetchone()
+            total = self.hits + self.misses
+            return {
+                'entries': count,
+                'bytes': size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+completion_cache = CompletionCache()
@@ -0,0 +1,171 @@
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import llm_rate_limited
+
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', 5))
+LLM_READ_TIMEOUT = float(os.getenv('LLM_READ_TIMEOUT', 120))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 4))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', 1))
+LLM_BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', 30))
+LLM_POOL_SIZE = int(os.getenv('LLM_POOL_SIZE', 20))
+
+# Ответы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    pass
+
+
+# Клиент OpenAI-совместимого API: пул keep-alive соединений, таймауты, повторы с учётом Retry-After
+class LLMClient:
+    def __init__(self, api_key, base_url=OPENAI_BASE_URL, connect_timeout=LLM_CONNECT_TIMEOUT,
+                 read_timeout=LLM_READ_TIMEOUT, max_retries=LLM_MAX_RETRIES, pool_size=LLM_POOL_SIZE, scheduler=None):
+        self.api_key = api_key
+        self.scheduler = scheduler
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers['Authorization'] = f"Bearer {self.api_key}"
+                    self._session = session
+        return self._session
+
+    # Закрытие пула соединений; следующий запрос откроет новый (нужно после fork)
+    def reset(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+    @staticmethod
+    def _retry_delay(response, attempt):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+            # Нераспознанная дата: Python 3.8 бросает TypeError, новые версии — ValueError; тогда обычная пауза
+            try:
+                parsed = email.utils.parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                parsed = None
+            if parsed is not None:
+                return max(0.0, parsed.timestamp() - time.time())
+        delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    # Каждая попытка проходит через планировщик (если он задан) с резервом tokens;
+    # возвращает ответ и резерв, который вызывающий пересчитывает по фактическому расходу
+    def _post(self, payload, stream=False, tokens=0):
+        url = f"{self.base_url}/chat/completions"
+        for attempt in range(self.max_retries + 1):
+            response = None
+            reservation = self.scheduler.acquire(tokens) if self.scheduler else None
+            try:
+                response = self._get_session().post(url, json=payload, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._settle(reservation, 0)
+                if attempt == self.max_retries:
+                    raise LLMError(f"LLM request failed: {e}") from e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    break
+                self._settle(reservation, 0)
+                if response.status_code == 429:
+                    llm_rate_limited.inc()
+                if attempt == self.max_retries:
+                    break
+                response.close()
+            delay = self._retry_delay(response, attempt)
+            # После 429 ждут все запросы процесса, а не только повторяемый
+            if self.scheduler and response is not None and response.status_code == 429:
+                self.scheduler.penalize(delay)
+            time.sleep(delay)
+
+        if response.status_code >= 400:
+            self._settle(reservation, 0)
+            raise LLMError(f"LLM request failed with status {response.status_code}: {response.text[:500]}")
+        return response, reservation
+
+    def _estimate(self, prompt):
+        return self.scheduler.estimate(prompt) if self.scheduler else 0
+
+    def _settle(self, reservation, total_tokens, completion_tokens=None):
+        if reservation is not None:
+            self.scheduler.settle(reservation, total_tokens, completion_tokens)
+
+    def complete(self, prompt, model, temperature):
+        tokens = self._estimate(prompt)
+        response, reservation = self._post({
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature
+        }, tokens=tokens)
+        try:
+            data = response.json()
+        except ValueError as e:
+            self._settle(reservation, tokens)
+            raise LLMError(f"LLM returned an invalid response: {e}") from e
+        usage = data.get('usage') or {}
+        self._settle(reservation, usage.get('total_tokens', tokens), usage.get('completion_tokens'))
+        return data['choices'][0]['message']['content']
+
+    # Генератор фрагментов текста по мере их поступления (server-sent events от API)
+    def stream(self, prompt, model, temperature):
+        response, reservation = self._post({
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+            "stream": True
+        }, stream=True, tokens=self._estimate(prompt))
+        parts = []
+        usage = None
+        try:
+            # Декодируем сами: у text/event-stream кодировка в заголовках часто не указана
+            for raw_line in response.iter_lines():
+                line = raw_line.decode('utf-8')
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                usage = chunk.get('usage') or usage
+                # Последнее событие с usage приходит без choices
+                delta = (chunk.get('choices') or [{}])[0].get('delta', {})
+                if delta.get('content'):
+                    parts.append(delta['content'])
+                    yield delta['content']
+        finally:
+            response.close()
+            if reservation is not None:
+                # Без usage в потоке расход оценивается по тексту промпта и полученного ответа
+                if not usage:
+                    completion_tokens = self.scheduler.count_tokens(''.join(parts))
+                    usage = {
+                        'total_tokens': self.scheduler.count_tokens(prompt) + completion_tokens,
+                        'completion_tokens': completion_tokens
+                    }
+                self._settle(reservation, usage['total_tokens'], usage.get('completion_tokens'))
@@ -0,0 +1,176 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from .context import estimate_tokens
+from .llm_client import LLMError
+from .metrics import llm_queue_depth, llm_queue_wait
+
+# Лимиты провайдера на запросы и токены в минуту (0 — без ограничения)
+LLM_RPM_LIMIT = int(os.getenv('LLM_RPM_LIMIT', 0))
+LLM_TPM_LIMIT = int(os.getenv('LLM_TPM_LIMIT', 0))
+# Начальная оценка длины ответа в токенах; дальше уточняется по usage из ответов
+LLM_COMPLETION_TOKENS = int(os.getenv('LLM_COMPLETION_TOKENS', 800))
+# Сколько запрос может ждать своей очереди, прежде чем завершиться ошибкой
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', 300))
+
+# Очереди в порядке убывания приоритета: интерактивные запросы обслуживаются раньше пакетных
+PRIORITIES = ('interactive', 'bulk')
+# Вес нового наблюдения в скользящей средней длины ответа
+COMPLETION_SMOOTHING = 0.2
+
+llm_priority = contextvars.ContextVar('llm_priority', default='interactive')
+
+
+# Приоритет LLM-запросов, сделанных внутри блока (в том числе из пулов потоков с копией контекста)
+@contextmanager
+def priority(name):
+    token = llm_priority.set(name)
+    try:
+        yield
+    finally:
+        llm_priority.reset(token)
+
+
+class SchedulerTimeout(LLMError):
+    pass
+
+
+# Ведро токенов, пополняемое равномерно до limit единиц в минуту
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.set_limit(per_minute)
+
+    def set_limit(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity > 0:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    # Сколько секунд ждать, пока в ведре наберётся amount (запрос больше ёмкости ждёт полного ведра)
+    def wait_time(self, amount, now):
+        if self.capacity <= 0:
+            return 0.0
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.capacity)
+
+    def take(self, amount):
+        if self.capacity > 0:
+            self.level -= min(amount, self.capacity)
+
+    # Возврат (или доплата при отрицательном amount) после того, как стал известен фактический расход
+    def give(self, amount):
+        if self.capacity > 0:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class Reservation:
+    __slots__ = ('tokens', 'priority', 'settled')
+
+    def __init__(self, tokens, priority):
+        self.tokens = tokens
+        self.priority = priority
+        self.settled = False
+
+
+# Общий планировщик LLM-запросов процесса: очереди по приоритетам и вёдра RPM/TPM.
+# Запрос резервирует оценку токенов до отправки, после ответа резерв пересчитывается по usage;
+# 429 от провайдера приостанавливает выдачу на время Retry-After
+class LLMScheduler:
+    def __init__(self, rpm=LLM_RPM_LIMIT, tpm=LLM_TPM_LIMIT, completion_tokens=LLM_COMPLETION_TOKENS,
+                 timeout=LLM_QUEUE_TIMEOUT):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.completion_tokens = float(completion_tokens)
+        self.timeout = timeout
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._queues = {name: deque() for name in PRIORITIES}
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    # Доля общих лимитов для одного из shards процессов (воркеров gunicorn)
+    def set_shards(self, shards):
+        shards = max(1, shards)
+        with self._cond:
+            self._requests.set_limit(self.rpm / shards)
+            self._tokens.set_limit(self.tpm / shards)
+            self._cond.notify_all()
+
+    @staticmethod
+    def count_tokens(text):
+        return estimate_tokens(text)
+
+    # Оценка расхода запроса до отправки: промпт плюс средняя длина ответа
+    def estimate(self, prompt):
+        return estimate_tokens(prompt) + int(self.completion_tokens)
+
+    def _head(self):
+        for name in PRIORITIES:
+            if self._queues[name]:
+                return self._queues[name][0]
+        return None
+
+    def acquire(self, tokens, priority=None):
+        priority = priority or llm_priority.get()
+        reservation = Reservation(tokens, priority)
+        queue = self._queues[priority]
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            queue.append(reservation)
+            llm_queue_depth.set(len(queue), priority=priority)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self._head() is reservation:
+                        wait = max(self._paused_until - now, self._requests.wait_time(1, now),
+                                   self._tokens.wait_time(tokens, now))
+                        if wait <= 0:
+                            self._requests.take(1)
+                            self._tokens.take(tokens)
+                            break
+                    if now >= deadline:
+                        raise SchedulerTimeout(f"LLM request waited in the {priority} queue for {self.timeout}s")
+                    self._cond.wait(min(wait, deadline - now) if wait is not None else deadline - now)
+            finally:
+                queue.remove(reservation)
+                llm_queue_depth.set(len(queue), priority=priority)
+                self._cond.notify_all()
+        llm_queue_wait.observe(time.monotonic() - started, priority=priority)
+        return reservation
+
+    # Пересчёт резерва по фактическому расходу; completion_tokens уточняет оценку следующих запросов
+    def settle(self, reservation, total_tokens, completion_tokens=None):
+        if reservation.settled:
+            return
+        reservation.settled = True
+        with self._cond:
+            self._tokens.give(reservation.tokens - total_tokens)
+            if completion_tokens is not None:
+                self.completion_tokens += COMPLETION_SMOOTHING * (completion_tokens - self.completion_tokens)
+            self._cond.notify_all()
+
+    def penalize(self, seconds):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'rpm_limit': self._requests.capacity,
+                'tpm_limit': self._tokens.capacity,
+                'completion_tokens_estimate': self.completion_tokens,
+                'queued': {name: len(queue) for name, queue in self._queues.items()},
+                'paused_for': max(0.0, self._paused_until - time.monotonic())
+            }
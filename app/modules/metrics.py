@@ -0,0 +1,196 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            # Бакеты кумулятивные, как требует формат Prometheus
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    # Сумма наблюдений по каждому набору меток
+    def sums(self):
+        with self._lock:
+            return {key: total for key, (_, total, _) in self._values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+# Реестр метрик процесса и функции, обновляющие gauge-метрики перед выдачей
+registry = []
+collectors = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+def render():
+    for collect in collectors:
+        collect()
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+stage_duration = register(Histogram(
+    'rag_stage_duration_seconds', 'Duration of request and indexing stages', ['stage']
+))
+requests_total = register(Counter(
+    'rag_requests_total', 'HTTP requests by endpoint and status', ['endpoint', 'status']
+))
+request_duration = register(Histogram(
+    'rag_request_duration_seconds', 'HTTP request latency by endpoint', ['endpoint']
+))
+prompt_chars = register(Histogram(
+    'rag_prompt_chars', 'Size of prompts sent to the LLM in characters', buckets=SIZE_BUCKETS
+))
+response_chars = register(Histogram(
+    'rag_response_chars', 'Size of LLM responses in characters', buckets=SIZE_BUCKETS
+))
+singleflight_calls = register(Counter(
+    'rag_singleflight_calls_total', 'Calls through single-flight groups: leaders ran the call, followers reused it',
+    ['flight', 'role']
+))
+llm_queue_depth = register(Gauge(
+    'rag_llm_queue_depth', 'LLM requests waiting in the scheduler by priority', ['priority']
+))
+llm_queue_wait = register(Histogram(
+    'rag_llm_queue_wait_seconds', 'Time LLM requests spent waiting in the scheduler by priority', ['priority']
+))
+llm_rate_limited = register(Counter(
+    'rag_llm_rate_limited_total', 'LLM API responses with status 429'
+))
+cache_stats = register(Gauge(
+    'rag_cache', 'Cache statistics by cache and field', ['cache', 'field']
+))
+
+# Разбивка времени по этапам в рамках текущего запроса (для ответа с debug)
+_request_stages = contextvars.ContextVar('request_stages', default=None)
+
+
+def start_request():
+    _request_stages.set({})
+
+
+def request_stages():
+    stages = _request_stages.get()
+    return dict(stages) if stages is not None else {}
+
+
+def record_stage(stage, seconds):
+    stage_duration.observe(seconds, stage=stage)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+# Обёртка итератора, считающая время, проведённое внутри next() (включая вложенные этапы конвейера)
+class TimedIterator:
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self.elapsed += time.perf_counter() - started
@@ -1,16 +1,123 @@
+import hashlib
 import json
 import os
+from collections import namedtuple
+
+from .few_shot import FewShotStore
+
+EXAMPLES_FILE = '../examples.json'
+
+BASIC_STRUCTURE = "Критически важно, чтобы ответ состоял только из разделов и тем и не включать никакую дополнительную информацию, примечания и комментарии."
+
+LEVEL_DETAILS = {
+    "бакалавриат": "Ты разрабатываешь программу курса для студентов бакалавриата, которые впервые сталкиваются с этими темами. Сосредоточься на основных понятиях.",
+    "магистратура": "Ты разрабатываешь программу курса для студентов магистратуры, которые уже знакомы с базовыми аспектами и готовы к более глубокому изучению предмета."
+}
+
+TREE_OF_THOUGHT = (
+    "Смоделируй ситуацию, где 100 экспертов создают курс по дисциплине. Каждый эксперт включает в свой курс от 5 до 7 тем. "
+    "Твоя задача — проанализировать эти программы, чтобы создать список основных тем, которые должны быть освоены. "
+    "Начни с определения тем, которые встречаются как минимум в 5 программах. "
+    "Рассмотри, почему эти темы часто выбираются экспертами: возможно, они являются фундаментальными "
+    "или критически важными для понимания дисциплины. "
+    "Затем проанализируй, как взаимосвязаны эти популярные темы и как исключение менее популярных тем может "
+    "повлиять на общее понимание дисциплины. "
+    "По результатам анализа, предложи итоговый список тем, объяснив, как каждая из них способствует "
+    "достижению образовательных целей курса."
+)
+
+CHAIN_OF_THOUGHT = (
+    "Начни с анализа того, какие знания, умения и навыки у студентов уже есть до начала курса. "
+    "Затем, для каждого раздела курса, объясни, почему ты выбрал именно эти темы и подтемы, "
+    "и как они связаны с предыдущими знаниями студентов. "
+    "Включи размышления о том, как каждая тема подготавливает студентов к последующим темам, "
+    "обоснуй, почему ты считаешь, что после изучения одной темы студенты готовы перейти к следующей. "
+    "Приведи примеры заданий или проектов, которые помогут закрепить полученные знания и навыки. "
+    "Подведи итог, объясняя, как вся структура курса способствует достижению образовательных целей дисциплины."
+)
+
+# Постоянная часть инструкции для каждого подхода; None — часть, зависящая от запроса (примеры few-shot)
+APPROACHES = {
+    'zero-shot': "",
+    'few-shot': None,
+    'chain-of-thought': CHAIN_OF_THOUGHT,
+    'tree-of-thought': TREE_OF_THOUGHT
+}
+
+# Неизменяемое описание одного промпта; создаётся на каждый запрос и может свободно передаваться между потоками
+PromptSpec = namedtuple('PromptSpec', 'title context keywords level hours use_rag approach')
+
+
+def _escape(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+# Шаблон для пары (подход, уровень): постоянные фрагменты собраны заранее, при запросе подставляются
+# только название, контекст, часы, ключевые слова и примеры. Версия — хэш текста шаблона,
+# она меняется при любой правке формулировок и может входить в ключи кэшей
+class PromptTemplate:
+    def __init__(self, approach, level):
+        approach_text = APPROACHES[approach]
+        self.approach = approach
+        self.level = level
+        self.template = (
+            "Ты помощник преподавателя. {context}Разработай структуру курса по дисциплине «{title}». "
+            f"{_escape(LEVEL_DETAILS.get(level, ''))} {{hours}} {{keywords}} "
+            f"{'{few_shot}' if approach_text is None else _escape(approach_text)} {_escape(BASIC_STRUCTURE)}"
+        )
+        digest = hashlib.sha1(self.template.encode('utf-8')).hexdigest()[:10]
+        self.version = f"{approach}/{level or '-'}:{digest}"
+
+    def render(self, spec, few_shot):
+        use_rag = spec.use_rag
+        return self.template.format(
+            context=f"Используя информацию об имеющихся в университете курсах: {spec.context}, " if use_rag and spec.context else "",
+            title=spec.title,
+            hours=f"Программа рассчитана на {spec.hours} академических лекционных часов. Исходя из этого, определи оптимальное количество материала для включения в курс." if spec.hours else "",
+            keywords=f"Преподаватель попросил включить следующие темы: {', '.join(spec.keywords)}. " if use_rag and spec.keywords else "",
+            few_shot=few_shot.prompt(spec.title) if APPROACHES[self.approach] is None else ""
+        )
+
+
+def load_examples(examples_file):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(current_dir, examples_file), 'r') as file:
+        return json.load(file)
+
+
+# Все шаблоны компилируются один раз при импорте; дальше только читаются, поэтому блокировки не нужны
+TEMPLATES = {
+    (approach, level): PromptTemplate(approach, level)
+    for approach in APPROACHES
+    for level in list(LEVEL_DETAILS) + [None]
+}
+EXAMPLES = load_examples(EXAMPLES_FILE)
+few_shot_store = FewShotStore(EXAMPLES)
+
+
+def get_template(approach, level):
+    if approach not in APPROACHES:
+        raise ValueError("Unsupported prompt type")
+    return TEMPLATES[(approach, level if level in LEVEL_DETAILS else None)]
+
+
+def template_version(approach, level):
+    return get_template(approach, level).version
 
 
+def render_prompt(spec, few_shot=few_shot_store):
+    if not spec.title:
+        raise ValueError("Title must be set for the prompt")
+    return get_template(spec.approach, spec.level).render(spec, few_shot)
+
+
+# Построитель с прежним интерфейсом: накапливает параметры одного промпта и превращает их в PromptSpec.
+# Экземпляр не должен разделяться между запросами — prompt_creator создаёт спецификацию напрямую
 class PromptBuilder:
     def __init__(self, examples_file=None):
         self.reset()
-        self.examples = {}
-        if examples_file:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            examples_file_path = os.path.join(current_dir, examples_file)
-            with open(examples_file_path, 'r') as file:
-                self.examples = json.load(file)
+        self.examples = load_examples(examples_file) if examples_file else {}
+        self.few_shot = FewShotStore(self.examples)
 
     def reset(self):
         self._title = None
@@ -50,71 +157,12 @@ class PromptBuilder:
         self._approach = approach
         return self
 
-    def construct_prompt(self):
-        if not self._title:
-            raise ValueError("Title must be set for the prompt")
-
-        basic_structure = "Критически важно, чтобы ответ состоял только из разделов и тем и не включать никакую дополнительную информацию, примечания и комментарии."
-        context_prompt = f"Используя информацию об имеющихся в университете курсах: {self._context}, " if self._use_rag and self._context else ""
-        keywords_prompt = f"Преподаватель попросил включить следующие темы: {', '.join(self._keywords)}. " if self._use_rag and self._keywords else ""
-
-        level_details = self._generate_level_details()
-
-        hours_details = f"Программа рассчитана на {self._hours} академических лекционных часов. Исходя из этого, определи оптимальное количество материала для включения в курс." if self._hours else ""
-
-        approach_specific_prompt = self._generate_approach_specific_prompt()
-
-        final_prompt = f"Ты помощник преподавателя. {context_prompt}Разработай структуру курса по дисциплине «{self._title}». {level_details} {hours_details} {keywords_prompt} {approach_specific_prompt} {basic_structure}"
-        return final_prompt
-
-    def _generate_level_details(self):
-        if self._level == "бакалавриат":
-            return "Ты разрабатываешь программу курса для студентов бакалавриата, которые впервые сталкиваются с этими темами. Сосредоточься на основных понятиях."
-        elif self._level == "магистратура":
-            return "Ты разрабатываешь программу курса для студентов магистратуры, которые уже знакомы с базовыми аспектами и готовы к более глубокому изучению предмета."
-        return ""
-
-    def _generate_approach_specific_prompt(self):
-        if self._approach == 'zero-shot':
-            return ''
-        if self._approach == 'few-shot':
-            return self._generate_few_shot_prompt()
-        elif self._approach == 'chain-of-thought':
-            return self._chain_of_thought()
-        elif self._approach == 'tree-of-thought':
-            return self._tree_of_thought()
-        else:
-            raise ValueError("Unsupported prompt type")
-
-    def _tree_of_thought(self):
-        return (
-            "Смоделируй ситуацию, где 100 экспертов создают курс по дисциплине. Каждый эксперт включает в свой курс от 5 до 7 тем. "
-            "Твоя задача — проанализировать эти программы, чтобы создать список основных тем, которые должны быть освоены. "
-            "Начни с определения тем, которые встречаются как минимум в 5 программах. "
-            "Рассмотри, почему эти темы часто выбираются экспертами: возможно, они являются фундаментальными "
-            "или критически важными для понимания дисциплины. "
-            "Затем проанализируй, как взаимосвязаны эти популярные темы и как исключение менее популярных тем может "
-            "повлиять на общее понимание дисциплины. "
-            "По результатам анализа, предложи итоговый список тем, объяснив, как каждая из них способствует "
-            "достижению образовательных целей курса."
-        )
+    def spec(self):
+        return PromptSpec(self._title, self._context, tuple(self._keywords), self._level, self._hours,
+                          self._use_rag, self._approach)
 
-    def _chain_of_thought(self):
-        return (
-            "Начни с анализа того, какие знания, умения и навыки у студентов уже есть до начала курса. "
-            "Затем, для каждого раздела курса, объясни, почему ты выбрал именно эти темы и подтемы, "
-            "и как они связаны с предыдущими знаниями студентов. "
-            "Включи размышления о том, как каждая тема подготавливает студентов к последующим темам, "
-            "обоснуй, почему ты считаешь, что после изучения одной темы студенты готовы перейти к следующей. "
-            "Приведи примеры заданий или проектов, которые помогут закрепить полученные знания и навыки. "
-            "Подведи итог, объясняя, как вся структура курса способствует достижению образовательных целей дисциплины."
-        )
-
-    def _generate_few_shot_prompt(self):
-        if self._title in self.examples:
-            examples_text = "\n\n".join([f"Пример {i + 1}:\n{example}" for i, example in enumerate(self.examples[self._title])])
-            return f"Для лучшего понимания структуры, включи в запрос следующие примеры:\n{examples_text}"
-        return ""
+    def construct_prompt(self):
+        return render_prompt(self.spec(), self.few_shot)
 
     def build(self):
         prompt = self.construct_prompt()
@@ -122,22 +170,9 @@ class PromptBuilder:
         return prompt
 
 
-# Пример использования:
-builder = PromptBuilder(examples_file='../examples.json')
-
-
 def prompt_creator(
         approach, context, title,
         keywords, level, hours, rag
 ):
-    prompt = (
-        builder.set_title(title)
-        .set_context(context)
-        .set_keywords(keywords.split(', '))
-        .set_education_level(level)
-        .set_hours(hours)
-        .use_rag(rag)
-        .set_approach(approach)
-        .build())
-
-    return prompt
+    spec = PromptSpec(title, context, tuple(keywords.split(', ')), level, hours, rag, approach)
+    return render_prompt(spec)
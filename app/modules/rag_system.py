@@ -1,10 +1,26 @@
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import threading
+import time
 import psycopg2
-import requests
-import pymorphy2
 from dotenv import load_dotenv
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import parallel_bulk, scan, streaming_bulk
+
+from .cache import make_cache
+from .context import assemble_context
+from .llm_cache import completion_cache
+from .llm_client import LLMClient
+from .llm_scheduler import LLMScheduler
+from .retrievers import ElasticsearchRetriever, TfidfRetriever
+from .metrics import TimedIterator, record_stage, timed
+from .lemmatizer import lemma_cache, lemmatize_text, lemmatize_texts
+from .singleflight import SingleFlight
+from .stopwords import load_stopwords
 
 educational_stopwords = [
     'курс', 'дисциплина', 'студент', 'система', 'метод', 'процесс', 'навык', 'работа', 'изучение', 'знание', 'задача',
@@ -15,31 +31,105 @@ educational_stopwords = [
     'лабораторный', 'профессиональный', 'основа', 'анализ', 'проблема'
 ]
 
+
+# Ручной список дополняется стоп-словами, подобранными по корпусу (python -m modules.stopwords)
+def index_stopwords():
+    return list(dict.fromkeys(educational_stopwords + load_stopwords()))
+
 load_dotenv()
 
 # Параметры подключения к Elasticsearch
 es_host = os.getenv('ELASTICSEARCH_HOST', 'localhost')
 elastic_password = os.getenv('ELASTIC_PASSWORD')
 api_key = os.getenv('API_KEY')
-es = Elasticsearch([f"http://{es_host}:9200"], http_auth=('elastic', elastic_password))
 
-# Создание индекса в Elasticsearch, если он еще не существует
-index_name = "courses"
+# Клиент создаётся лениво при первом обращении, а не при импорте модуля
+_es = None
+_es_lock = threading.Lock()
 
-morph = pymorphy2.MorphAnalyzer()
 
+def get_es():
+    global _es
+    if _es is None:
+        with _es_lock:
+            if _es is None:
+                _es = Elasticsearch([f"http://{es_host}:9200"], http_auth=('elastic', elastic_password))
+    return _es
 
-def lemmatize_text(text):
-    if text is None:
-        return ""
-    words = text.split()  # Разбиение текста на слова
-    lemmatized_words = [morph.parse(word)[0].normal_form for word in words]
-    return ' '.join(lemmatized_words)  # Соединение слов обратно в строку
 
+# Имя алиаса, через который идёт поиск; сами данные лежат в версионированных индексах courses_<время в мс>
+index_name = "courses"
 
-def create_index(es, index_name):
-    if es.indices.exists(index=index_name):
-        es.indices.delete(index=index_name)
+# Как часто сообщать о ходе подготовки документов при индексации
+PROGRESS_EVERY = 1000
+
+# Размеры порций при чтении из PostgreSQL и записи в Elasticsearch
+FETCH_BATCH_SIZE = int(os.getenv('FETCH_BATCH_SIZE', 2000))
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 500))
+BULK_MAX_CHUNK_BYTES = int(os.getenv('BULK_MAX_CHUNK_BYTES', 10 * 1024 * 1024))
+BULK_THREADS = int(os.getenv('BULK_THREADS', 1))
+
+# Подготовка документов в пуле процессов: число процессов и курсов в одной порции задания
+INDEX_WORKERS = int(os.getenv('INDEX_WORKERS', 1))
+INDEX_CHUNK_SIZE = int(os.getenv('INDEX_CHUNK_SIZE', 50))
+
+# Кэш результатов поиска и частота проверки поколения индекса (секунды)
+RETRIEVAL_CACHE_SIZE = int(os.getenv('RETRIEVAL_CACHE_SIZE', 10000))
+RETRIEVAL_CACHE_TTL = float(os.getenv('RETRIEVAL_CACHE_TTL', 3600))
+GENERATION_CHECK_INTERVAL = float(os.getenv('GENERATION_CHECK_INTERVAL', 5))
+SEARCH_SIZE = 10
+
+# Бэкенд поиска и расположение TF-IDF индекса для бэкенда tfidf
+RETRIEVER_BACKEND = os.getenv('RETRIEVER_BACKEND', 'elasticsearch')
+TFIDF_INDEX_PATH = os.getenv(
+    'TFIDF_INDEX_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tfidf_index')
+)
+
+# Профиль маппинга индекса: default или compact (лемматизированные поля не хранятся в _source,
+# у полей настроены index_options и norms, stored fields сжаты сильнее)
+INDEX_PROFILE = os.getenv('INDEX_PROFILE', 'default')
+# Морфология на стороне Elasticsearch (плагин analysis-morphology) вместо полей, лемматизированных в Python
+ES_MORPHOLOGY = os.getenv('ES_MORPHOLOGY', '0') == '1'
+LEMMATIZED_FIELDS = ['title_lemmatized', 'description_lemmatized', 'sections_lemmatized', 'topics_lemmatized']
+
+# Параметры генерации
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-3.5-turbo')
+LLM_TEMPERATURE = float(os.getenv('LLM_TEMPERATURE', 0.7))
+
+
+def versioned_index_name():
+    return f"{index_name}_{int(time.time() * 1000)}"
+
+
+def index_mapping(profile=INDEX_PROFILE, morphology=ES_MORPHOLOGY):
+    if profile not in ('default', 'compact'):
+        raise ValueError(f"Unsupported index profile: {profile}")
+    compact = profile == 'compact'
+    stemming = ["russian_morphology", "english_morphology"] if morphology else ["snowball"]
+    text = {"type": "text", "analyzer": "custom_standard_analyzer"}
+    if compact:
+        # Запросы не используют фразы, позиции не нужны; у списков разделов и тем длина поля не должна
+        # штрафовать курс, поэтому norms отключены. Название показывается, но не ищется
+        searched = dict(text, index_options="freqs")
+        properties = {
+            "id": {"type": "keyword"},
+            "title": dict(text, index=False),
+            "description": searched,
+            "sections": dict(searched, norms=False),
+            "topics": dict(searched, norms=False)
+        }
+    else:
+        properties = {"id": {"type": "keyword"}}
+        properties.update((field, text) for field in ("title", "description", "sections", "topics"))
+    if not morphology:
+        for field in LEMMATIZED_FIELDS:
+            # Название в compact не ищется, его лемматизированная копия в документы не попадает
+            if not (compact and field == 'title_lemmatized'):
+                properties[field] = properties[field[:-len('_lemmatized')]]
+    properties["content_hash"] = {"type": "keyword", "index": False}
+    if compact:
+        properties["content_hash"]["doc_values"] = False
 
     mapping = {
         "settings": {
@@ -48,219 +138,535 @@ def create_index(es, index_name):
                     "custom_standard_analyzer": {
                         "type": "custom",
                         "tokenizer": "standard",
-                        "filter": ["lowercase", "stop", "snowball", "english_stop", "russian_stop", "subject_stop"],
+                        # subject_stop стоит до стемминга: стоп-слова корпуса сохранены в той же форме, что и
+                        # токены TF-IDF бэкенда (леммы pymorphy2 для русского, исходные слова для английского),
+                        # а snowball превратил бы английские "methods" в "method" до сравнения. С морфологией
+                        # фильтр повторяется после неё, чтобы леммы совпадали и в исходных полях
+                        "filter": ["lowercase", "stop", "subject_stop"] + stemming + ["english_stop", "russian_stop"]
+                                  + (["subject_stop"] if morphology else []),
                     }
                 },
                 "filter": {
                     "english_stop": {"type": "stop", "stopwords": "_english_"},
                     "russian_stop": {"type": "stop", "stopwords": "_russian_"},
-                    "subject_stop": {"type": "stop", "stopwords": educational_stopwords}
+                    "subject_stop": {"type": "stop", "stopwords": index_stopwords()}
                 }
             }
         },
         "mappings": {
-            "properties": {
-                "id": {"type": "keyword"},
-                "title": {"type": "text", "analyzer": "custom_standard_analyzer"},
-                "description": {"type": "text", "analyzer": "custom_standard_analyzer"},
-                "sections": {"type": "text", "analyzer": "custom_standard_analyzer"},
-                "topics": {"type": "text", "analyzer": "custom_standard_analyzer"},
-                "title_lemmatized": {"type": "text", "analyzer": "custom_standard_analyzer"},
-                "description_lemmatized": {"type": "text", "analyzer": "custom_standard_analyzer"},
-                "sections_lemmatized": {"type": "text", "analyzer": "custom_standard_analyzer"},
-                "topics_lemmatized": {"type": "text", "analyzer": "custom_standard_analyzer"}
-            }
+            "properties": properties
         }
     }
+    if compact:
+        mapping["settings"]["index"] = {"codec": "best_compression"}
+        # Лемматизированные копии только ищутся и никогда не показываются
+        mapping["mappings"]["_source"] = {"excludes": ["*_lemmatized"]}
+    return mapping
 
-    es.indices.create(index=index_name, body=mapping)
+
+def create_index(es, index_name):
+    if es.indices.exists(index=index_name):
+        es.indices.delete(index=index_name)
+    es.indices.create(index=index_name, body=index_mapping())
+
+
+# Запрос агрегирует темы и разделы на стороне БД: одна строка на курс вместо строки на каждую тему
+COURSES_QUERY = (
+    "select wd.work_program_id, title as course_title, ww.description as course_description, "
+    "array_agg(distinct name) as sections, array_agg(distinct wt.description) as section_topics "
+    "from workprogramsapp_topic wt "
+    "join workprogramsapp_disciplinesection wd on wd.id = wt.discipline_section_id "
+    "join workprogramsapp_expertise we on wd.work_program_id = we.work_program_id "
+    "join workprogramsapp_workprogram ww on wd.work_program_id = ww.id "
+    "where work_status = 'a' "
+    "group by wd.work_program_id, title, ww.description"
+)
 
 
-# Подключение к базе данных и извлечение данных
+# Подключение к базе данных и потоковое извлечение данных
 def fetch_courses():
     database_url = os.getenv('DATABASE_URL')
     conn = psycopg2.connect(database_url)
-    cursor = conn.cursor()
-    query = ("select wd.work_program_id, title as course_title, ww.description as course_description, "
-             "name as section, wt.description as section_topic "
-             "from workprogramsapp_topic wt "
-             "join workprogramsapp_disciplinesection wd on wd.id = wt.discipline_section_id "
-             "join workprogramsapp_expertise we on wd.work_program_id = we.work_program_id "
-             "join workprogramsapp_workprogram ww on wd.work_program_id = ww.id "
-             "where work_status = 'a'")
-    cursor.execute(query)
-    courses = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return courses
-
-
-# Индексация данных в Elasticsearch
-def index_courses(courses):
-    actions = [
-        {
-            "_index": index_name,
-            "_id": course_id,
-            "_source": data
+    try:
+        # Именованный (серверный) курсор отдаёт строки порциями по FETCH_BATCH_SIZE
+        with conn.cursor(name='courses_cursor') as cursor:
+            cursor.itersize = FETCH_BATCH_SIZE
+            cursor.execute(COURSES_QUERY)
+            for row in cursor:
+                yield row
+    finally:
+        conn.close()
+
+
+# Индекс(ы), на которые сейчас указывает алиас
+def current_indices(es):
+    if not es.indices.exists_alias(name=index_name):
+        return []
+    return list(es.indices.get_alias(name=index_name).keys())
+
+
+# Атомарное переключение алиаса на новый индекс и удаление старых версий
+def swap_alias(es, new_index):
+    old_indices = current_indices(es)
+    actions = [{"remove": {"index": old, "alias": index_name}} for old in old_indices]
+    # Индекс старого формата с именем алиаса удаляется в той же операции
+    if not old_indices and es.indices.exists(index=index_name):
+        actions.append({"remove_index": {"index": index_name}})
+    actions.append({"add": {"index": new_index, "alias": index_name}})
+    es.indices.update_aliases(body={"actions": actions})
+    for old in old_indices:
+        if old != new_index:
+            es.indices.delete(index=old)
+
+
+# Поколение индекса меняется при каждом изменении данных; по нему сбрасывается кэш поиска
+def bump_generation(es, index):
+    es.indices.put_mapping(index=index, body={"_meta": {"generation": str(time.time_ns())}})
+
+
+# Хэши содержимого уже проиндексированных курсов: id -> content_hash
+def fetch_indexed_hashes(es, index):
+    return {
+        hit['_id']: hit['_source'].get('content_hash')
+        for hit in scan(es, index=index, query={"_source": ["content_hash"]})
+    }
+
+
+# Индексация данных в Elasticsearch; courses — итерируемое пар (id, документ)
+def index_courses(courses, index=index_name, deleted_ids=(), progress=None):
+    actions = itertools.chain(
+        ({"_index": index, "_id": course_id, "_source": data} for course_id, data in courses),
+        ({"_op_type": "delete", "_index": index, "_id": course_id} for course_id in deleted_ids)
+    )
+
+    # Потоковая отправка порциями: в памяти одновременно находится не больше одной порции
+    es = get_es()
+    if BULK_THREADS > 1:
+        results = parallel_bulk(es, actions, thread_count=BULK_THREADS, chunk_size=BULK_CHUNK_SIZE,
+                                max_chunk_bytes=BULK_MAX_CHUNK_BYTES)
+    else:
+        results = streaming_bulk(es, actions, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES)
+
+    count = 0
+    for _ in results:
+        count += 1
+        if progress and count % PROGRESS_EVERY == 0:
+            progress('indexed', count)
+    if progress:
+        progress('indexed', count)
+    return count
+
+
+# Строка выборки -> (id, курс); порядок разделов и тем фиксирован, чтобы хэш был стабильным
+def row_to_course(row):
+    course_id, title, description, sections, topics = row
+    return course_id, {
+        'title': title,
+        'description': description,
+        'sections': sorted(set(sections or ()), key=lambda value: value or ''),
+        'topics': sorted(set(topics or ()), key=lambda value: value or '')
+    }
+
+
+def course_hash(course):
+    content = json.dumps(
+        [course['title'], course['description'], course['sections'], course['topics']],
+        ensure_ascii=False
+    )
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# Без lemmatize документ не содержит лемматизированных полей (морфология на стороне Elasticsearch)
+# lemmatize_title=False — для профиля compact, где название не ищется: title_lemmatized там не индексируется
+# и не хранится, поэтому не вычисляется и не отправляется
+def prepare_course(course, lemmatize=True, lemmatize_title=True):
+    sections = course['sections']
+    topics = course['topics']
+    if not lemmatize:
+        return {
+            'title': course['title'],
+            'description': course['description'],
+            'sections': sections,
+            'topics': topics,
+            'content_hash': course_hash(course)
         }
-        for course_id, data in courses.items()
-    ]
+    # Лемматизация одним пакетом на курс: повторяющиеся строки разбираются один раз
+    titles = [course['title']] if lemmatize_title else []
+    lemmatized = lemmatize_texts(titles + [course['description']] + sections + topics)
+    document = {
+        'title': course['title'],
+        'description': course['description'],
+        'sections': sections,
+        'topics': topics
+    }
+    if lemmatize_title:
+        document['title_lemmatized'] = lemmatized.pop(0)
+    document.update({
+        'description_lemmatized': lemmatized[0],
+        'sections_lemmatized': list(set(lemmatized[1:1 + len(sections)])),
+        'topics_lemmatized': list(set(lemmatized[1 + len(sections):])),
+        'content_hash': course_hash(course)
+    })
+    return document
 
-    # Использование bulk API для индексации данных
-    bulk(es, actions)
 
+def _prepare_item(item, lemmatize=True, lemmatize_title=True):
+    course_id, course = item
+    return course_id, prepare_course(course, lemmatize, lemmatize_title)
 
-def prepare_courses(rows):
-    course_data = {}
-    for row in rows:
-        course_id = row[0]
-        title = row[1]
-        description = row[2]
-        section = row[3]
-        topic = row[4]
-
-        if course_id not in course_data:
-            course_data[course_id] = {
-                'title': title,
-                'description': description,
-                'sections': set(),
-                'topics': set(),
-                'title_lemmatized': lemmatize_text(title),
-                'description_lemmatized': lemmatize_text(description),
-                'sections_lemmatized': set(),
-                'topics_lemmatized': set()
-            }
 
-        course_data[course_id]['sections'].add(section)
-        course_data[course_id]['topics'].add(topic)
-        course_data[course_id]['sections_lemmatized'].add(lemmatize_text(section))
-        course_data[course_id]['topics_lemmatized'].add(lemmatize_text(topic))
-
-    # Преобразование set в list для JSON-совместимости
-    for data in course_data.values():
-        data['sections'] = list(data['sections'])
-        data['topics'] = list(data['topics'])
-        data['sections_lemmatized'] = list(data['sections_lemmatized'])
-        data['topics_lemmatized'] = list(data['topics_lemmatized'])
-
-    return course_data
-
-
-def init():
-    create_index(es, index_name=index_name)
-    courses = fetch_courses()
-    if courses:
-        course_data = prepare_courses(courses)  # Агрегация данных
-        index_courses(course_data)  # Индексация данных
-        print("Courses indexed successfully!")
-
-
-# Поиск в Elasticsearch
-def search_courses(query):
-    body = {
-        "query": {
-            "function_score": {
-                "query": {
-                    "multi_match": {
-                        "query": query,
-                        "fields": [
-                            # "title_lemmatized^3",
-                            # "title^3",
-                            "description_lemmatized^2",
-                            "description^2",
-                            "sections_lemmatized^1.5",
-                            "sections^1.5",
-                            "topics_lemmatized",
-                            "topics"
-                        ],
-                        "type": "best_fields"
-                    }
-                },
-                "functions": [
-                    # {
-                    #     "filter": {"match": {"title_lemmatized": query}},
-                    #     "weight": 3
-                    # },
-                    {
-                        "filter": {"match": {"description": query}},
-                        "weight": 2
-                    },
-                    {
-                        "filter": {"match": {"description_lemmatized": query}},
-                        "weight": 2
-                    },
-                    {
-                        "filter": {"match": {"sections": query}},
-                        "weight": 2
-                    },
-                    {
-                        "filter": {"match": {"sections_lemmatized": query}},
-                        "weight": 1.5
-                    },
-                    {
-                        "filter": {"match": {"topics": query}},
-                        "weight": 1
-                    },
-                    {
-                        "filter": {"match": {"topics_lemmatized": query}},
-                        "weight": 1
-                    }
-                ],
-                "score_mode": "sum",  # Определяет, как итоговые счета функций должны быть суммированы
-                "boost_mode": "multiply"  # Определяет, как итоговый функциональный счет влияет на счет запроса
-            }
-        },
-        "_source": ["title", "title_lemmatized", "description", "description_lemmatized", "sections",
-                    "sections_lemmatized", "topics", "topics_lemmatized"],  # Указываем, какие поля нужно вернуть
-        "size": 10,  # Количество возвращаемых документов
-        "explain": True  # Включаем объяснение для каждого документа
+def _init_pool_worker():
+    lemma_cache.track_added()
+
+
+# В процессе пула к документу прикладываются леммы, которых не было в кэше, чтобы родитель сохранил их
+def _prepare_pooled_item(item, lemmatize=True, lemmatize_title=True):
+    course_id, document = _prepare_item(item, lemmatize, lemmatize_title)
+    return course_id, document, lemma_cache.take_added()
+
+
+def _merge_lemmas(prepared):
+    for course_id, document, added in prepared:
+        lemma_cache.update(added)
+        yield course_id, document
+
+
+# Документы готовятся по одному курсу и сразу отдаются дальше, без промежуточного словаря.
+# При workers > 1 курсы раздаются процессам порциями по chunk_size; imap сохраняет исходный порядок
+def prepare_courses(courses, progress=None, workers=1, chunk_size=INDEX_CHUNK_SIZE, lemmatize=True,
+                    lemmatize_title=True):
+    if workers > 1:
+        prepare_item = functools.partial(_prepare_pooled_item, lemmatize=lemmatize,
+                                         lemmatize_title=lemmatize_title)
+        with multiprocessing.Pool(workers, initializer=_init_pool_worker) as pool:
+            prepared = pool.imap(prepare_item, courses, chunksize=chunk_size)
+            yield from _count_prepared(_merge_lemmas(prepared), progress)
+    else:
+        prepare_item = functools.partial(_prepare_item, lemmatize=lemmatize, lemmatize_title=lemmatize_title)
+        yield from _count_prepared(map(prepare_item, courses), progress)
+
+
+def _count_prepared(prepared, progress):
+    count = 0
+    for item in prepared:
+        yield item
+        count += 1
+        if progress and count % PROGRESS_EVERY == 0:
+            progress('prepared', count)
+    if progress:
+        progress('prepared', count)
+
+
+def iter_courses(rows, progress=None):
+    count = 0
+    for row in rows:
+        yield row_to_course(row)
+        count += 1
+        if progress and count % PROGRESS_EVERY == 0:
+            progress('fetched', count)
+    if progress:
+        progress('fetched', count)
+
+
+# Время этапов конвейера индексации: итераторы вложены, поэтому из времени внешнего этапа вычитается время внутреннего.
+# При подготовке в пуле процессов чтение идёт в отдельном потоке, и этапы перекрываются
+def record_index_stages(courses, prepared, total):
+    record_stage('fetch_courses', courses.elapsed)
+    record_stage('prepare_courses', max(0.0, prepared.elapsed - courses.elapsed))
+    record_stage('index_courses', max(0.0, total - prepared.elapsed))
+
+
+# Полная перестройка в новый индекс с последующим переключением алиаса
+def full_sync(rows, progress=None, workers=INDEX_WORKERS, chunk_size=INDEX_CHUNK_SIZE):
+    es = get_es()
+    new_index = versioned_index_name()
+    create_index(es, index_name=new_index)
+    courses = TimedIterator(iter_courses(rows, progress))
+    prepared = TimedIterator(prepare_courses(courses, progress, workers, chunk_size, lemmatize=not ES_MORPHOLOGY,
+                                             lemmatize_title=INDEX_PROFILE != 'compact'))
+    started = time.perf_counter()
+    indexed = index_courses(prepared, index=new_index, progress=progress)
+    record_index_stages(courses, prepared, time.perf_counter() - started)
+    # Пустая выборка не должна подменять рабочий индекс
+    if not indexed:
+        es.indices.delete(index=new_index)
+        return None
+    es.indices.refresh(index=new_index)
+    bump_generation(es, new_index)
+    swap_alias(es, new_index)
+    return {'mode': 'full', 'index': new_index, 'indexed': indexed, 'deleted': 0, 'unchanged': 0}
+
+
+# Обновление только изменившихся курсов в текущем индексе
+def incremental_sync(rows, progress=None, workers=INDEX_WORKERS, chunk_size=INDEX_CHUNK_SIZE):
+    es = get_es()
+    indices = current_indices(es)
+    if len(indices) != 1:
+        return full_sync(rows, progress, workers, chunk_size)
+    index = indices[0]
+
+    indexed_hashes = fetch_indexed_hashes(es, index)
+    seen_ids = set()
+
+    courses = TimedIterator(iter_courses(rows, progress))
+
+    def changed_courses():
+        for course_id, course in courses:
+            seen_ids.add(str(course_id))
+            if indexed_hashes.get(str(course_id)) != course_hash(course):
+                yield course_id, course
+
+    prepared = TimedIterator(prepare_courses(changed_courses(), progress, workers, chunk_size,
+                                             lemmatize=not ES_MORPHOLOGY,
+                                             lemmatize_title=INDEX_PROFILE != 'compact'))
+    started = time.perf_counter()
+    indexed = index_courses(prepared, index=index, progress=progress)
+    record_index_stages(courses, prepared, time.perf_counter() - started)
+    if not seen_ids:
+        return None
+    deleted_ids = [course_id for course_id in indexed_hashes if course_id not in seen_ids]
+    if deleted_ids:
+        index_courses((), index=index, deleted_ids=deleted_ids)
+    if indexed or deleted_ids:
+        es.indices.refresh(index=index)
+        bump_generation(es, index)
+    return {
+        'mode': 'incremental',
+        'index': index,
+        'indexed': indexed,
+        'deleted': len(deleted_ids),
+        'unchanged': len(seen_ids) - indexed
     }
 
-    response = es.search(index=index_name, body=body)
-    results = []
-    for hit in response['hits']['hits']:
-        result_info = {
-            'title': hit['_source']['title'],
-            'description': hit['_source']['description'],
-            'sections': hit['_source']['sections'],
-            'topics': hit['_source']['topics'],
-            'score': hit['_score'],
-            'explanation': hit.get('_explanation', {})  # Добавляем объяснение в вывод, если доступно
-        }
-        results.append(result_info)
+
+# progress(stage, count) вызывается по ходу этапов fetched / prepared / indexed
+def sync_courses(full=False, progress=None, workers=INDEX_WORKERS, chunk_size=INDEX_CHUNK_SIZE):
+    rows = fetch_courses()
+    sync = full_sync if full else incremental_sync
+    stats = sync(rows, progress, workers, chunk_size)
+    lemma_cache.save()
+    return stats
+
+
+_retriever = None
+_retriever_lock = threading.Lock()
+
+
+# Бэкенд поиска выбирается переменной RETRIEVER_BACKEND: elasticsearch (по умолчанию) или tfidf
+def get_retriever():
+    global _retriever
+    if _retriever is None:
+        with _retriever_lock:
+            if _retriever is None:
+                if RETRIEVER_BACKEND == 'tfidf':
+                    _retriever = TfidfRetriever(TFIDF_INDEX_PATH)
+                elif RETRIEVER_BACKEND == 'elasticsearch':
+                    _retriever = ElasticsearchRetriever(get_es, index_name, lemmatized_fields=not ES_MORPHOLOGY)
+                else:
+                    raise ValueError(f"Unsupported retriever backend: {RETRIEVER_BACKEND}")
+    return _retriever
+
+
+retrieval_cache = make_cache('retrieval', RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL)
+search_flight = SingleFlight('search')
+
+_generation = {'value': None, 'checked_at': 0.0, 'refreshing': False}
+_generation_lock = threading.Lock()
+
+
+# Поколение данных бэкенда поиска, проверяется не чаще раза в GENERATION_CHECK_INTERVAL секунд.
+# Запрос к бэкенду идёт без блокировки: пока один поток его выполняет, остальные получают прежнее значение
+def index_generation():
+    now = time.monotonic()
+    with _generation_lock:
+        current = _generation['value']
+        if current is not None and (now - _generation['checked_at'] < GENERATION_CHECK_INTERVAL
+                                    or _generation['refreshing']):
+            return current
+        _generation['refreshing'] = True
+    try:
+        value = f"{get_retriever().name}:{get_retriever().generation()}"
+    finally:
+        with _generation_lock:
+            _generation['refreshing'] = False
+    with _generation_lock:
+        if value != _generation['value']:
+            retrieval_cache.clear()
+        _generation['value'] = value
+        _generation['checked_at'] = now
+    return value
+
+
+# Порядок слов не влияет на multi_match, поэтому запросы с переставленными словами дают один ключ
+def normalize_query(query):
+    return ' '.join(sorted(query.lower().split()))
+
+
+def retrieval_cache_key(normalized_query, size):
+    return hashlib.sha1(f"{index_generation()}|{size}|{normalized_query}".encode('utf-8')).hexdigest()
+
+
+def search_courses(query, size=SEARCH_SIZE, use_cache=True):
+    if not use_cache:
+        return get_retriever().search(query, size)
+    normalized = normalize_query(query)
+    key = retrieval_cache_key(normalized, size)
+    results = retrieval_cache.get(key)
+    if results is None:
+        # Одинаковые одновременные промахи кэша ждут один запрос к бэкенду
+        results = search_flight.do(key, _search_and_cache, key, normalized, size)
     return results
 
 
-def generate_text_with_chatgpt(prompt):
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {api_key}"
-        },
-        json={
-            "model": "gpt-3.5-turbo",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.7
-        }
-    )
-    return response.json()['choices'][0]['message']['content']
+def _search_and_cache(key, query, size):
+    results = get_retriever().search(query, size)
+    retrieval_cache.set(key, results)
+    return results
+
+
+# Пакетный поиск: промахи кэша уходят в бэкенд одним запросом (msearch / одно матричное умножение),
+# порядок результатов сохраняется
+def search_courses_many(queries, size=SEARCH_SIZE, use_cache=True):
+    normalized = [normalize_query(query) for query in queries]
+    # Без кэша ключи не нужны, и поколение индекса не запрашивается
+    keys = [retrieval_cache_key(query, size) for query in normalized] if use_cache else None
+    results = [retrieval_cache.get(key) for key in keys] if use_cache else [None] * len(normalized)
+
+    missing = {}
+    for position, result in enumerate(results):
+        if result is None:
+            missing.setdefault(normalized[position], []).append(position)
+    if missing:
+        missing_queries = list(missing)
+        for query, hits in zip(missing_queries, get_retriever().search_many(missing_queries, size)):
+            if use_cache:
+                retrieval_cache.set(keys[missing[query][0]], hits)
+            for position in missing[query]:
+                results[position] = hits
+    return results
+
+
+# Размер индекса на диске и задержка поиска — для сравнения профилей маппинга до и после переиндексации.
+# Запросы — лемматизированные названия sample курсов, выбранных из индекса с фиксированным seed,
+# или переданные queries
+def measure_index(sample=200, repeats=3, size=SEARCH_SIZE, queries=None):
+    es = get_es()
+    stats = es.indices.stats(index=index_name, metric='store,docs')['_all']['primaries']
+    # _seq_no после переиндексации зависит от порядка bulk-запросов, поэтому для сравнения
+    # передаются запросы прошлого замера, а не новая выборка
+    if queries is None:
+        response = es.search(index=index_name, body={
+            "size": sample,
+            "query": {"function_score": {"random_score": {"seed": 42, "field": "_seq_no"}}},
+            "_source": ["title"]
+        })
+        queries = lemmatize_texts([hit['_source']['title'] for hit in response['hits']['hits']])
+    retriever = ElasticsearchRetriever(get_es, index_name, lemmatized_fields=not ES_MORPHOLOGY)
+    latencies = []
+    for _ in range(repeats):
+        for query in queries:
+            started = time.perf_counter()
+            retriever.search(query, size)
+            latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    def percentile(q):
+        return 1000 * latencies[min(len(latencies) - 1, int(round(q * (len(latencies) - 1))))] if latencies else 0.0
+
+    return {
+        'profile': INDEX_PROFILE,
+        'morphology': ES_MORPHOLOGY,
+        'indices': current_indices(es),
+        'docs': stats['docs']['count'],
+        'store_bytes': stats['store']['size_in_bytes'],
+        'queries': len(latencies),
+        'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50_ms': percentile(0.5),
+        'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99),
+        'sample_queries': queries
+    }
 
 
-init()
+# Построение TF-IDF индекса для бэкенда tfidf из тех же подготовленных документов, что и для Elasticsearch
+def build_tfidf_index(progress=None, workers=INDEX_WORKERS, chunk_size=INDEX_CHUNK_SIZE, path=None):
+    courses = TimedIterator(iter_courses(fetch_courses(), progress))
+    prepared = TimedIterator(prepare_courses(courses, progress, workers, chunk_size))
+    started = time.perf_counter()
+    stats = TfidfRetriever.build(prepared, path or TFIDF_INDEX_PATH, stop_words=index_stopwords())
+    record_index_stages(courses, prepared, time.perf_counter() - started)
+    if progress:
+        progress('indexed', stats['documents'])
+    lemma_cache.save()
+    if not stats['documents']:
+        return None
+    return stats
+
+
+# Все вызовы LLM процесса проходят через общий планировщик с лимитами RPM/TPM
+llm_scheduler = LLMScheduler()
+llm_client = LLMClient(api_key, scheduler=llm_scheduler)
+llm_flight = SingleFlight('llm')
+
+
+# Сброс соединений, унаследованных от родительского процесса (вызывается после fork воркера)
+def reset_clients():
+    global _es, _retriever
+    with _es_lock:
+        _es = None
+    with _retriever_lock:
+        _retriever = None
+    llm_client.reset()
+    completion_cache.reset()
+
+
+# Возвращает (текст, взят_ли_ответ_из_кэша)
+def generate_text_with_chatgpt(prompt, use_cache=True):
+    key = completion_cache.make_key(LLM_MODEL, LLM_TEMPERATURE, prompt)
+    if use_cache:
+        cached = completion_cache.get(key)
+        if cached is not None:
+            return cached, True
+
+    # Одновременные запросы с тем же промптом ждут один ответ LLM
+    return llm_flight.do((key, use_cache), _complete_and_cache, key, prompt), False
+
+
+def _complete_and_cache(key, prompt):
+    text = llm_client.complete(prompt, LLM_MODEL, LLM_TEMPERATURE)
+    completion_cache.set(key, LLM_MODEL, LLM_TEMPERATURE, text)
+    return text
+
+
+# Потоковая генерация: возвращает (итератор фрагментов текста, взят_ли_ответ_из_кэша)
+def stream_text_with_chatgpt(prompt, use_cache=True):
+    key = completion_cache.make_key(LLM_MODEL, LLM_TEMPERATURE, prompt)
+    if use_cache:
+        cached = completion_cache.get(key)
+        if cached is not None:
+            return iter([cached]), True
+    return _stream_and_cache(key, prompt), False
+
+
+# Полный ответ попадает в кэш только если поток дочитан до конца
+def _stream_and_cache(key, prompt):
+    chunks = []
+    for chunk in llm_client.stream(prompt, LLM_MODEL, LLM_TEMPERATURE):
+        chunks.append(chunk)
+        yield chunk
+    completion_cache.set(key, LLM_MODEL, LLM_TEMPERATURE, ''.join(chunks))
 
 
 # Интеграция ретривера и генератора
 def rag_system(query):
-    hits = search_courses(query)  # убедитесь, что эта функция передаётся корректно и доступна в контексте
-    if hits:
-        top_hit = hits[0]  # Используем первый результат поиска
-        # Обновлено для использования новой структуры данных
-        return {
-            "text": f"{', '.join(top_hit['sections'])}. {', '.join(top_hit['topics'])}",
-            "explanation": top_hit['explanation']
-        }
-    else:
-        return {
-            "text": "",
-            "explanation": ""
-        }
+    with timed('search'):
+        hits = search_courses(query)
+    with timed('context'):
+        return assemble_context(hits)
+
+
+def rag_system_many(queries):
+    with timed('search'):
+        hits_list = search_courses_many(queries)
+    with timed('context'):
+        return [assemble_context(hits) for hits in hits_list]
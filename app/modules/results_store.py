@@ -0,0 +1,271 @@
+import atexit
+import glob
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+RESULTS_DIR = os.getenv(
+    'RESULTS_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'results')
+)
+# Размер сегмента, после которого запись продолжается в новый файл
+RESULTS_MAX_BYTES = int(os.getenv('RESULTS_MAX_BYTES', 64 * 1024 * 1024))
+# Как долго фоновый поток копит записи перед сбросом на диск и сколько записей сбрасывается за раз
+RESULTS_FLUSH_INTERVAL = float(os.getenv('RESULTS_FLUSH_INTERVAL', 1))
+RESULTS_BATCH_SIZE = int(os.getenv('RESULTS_BATCH_SIZE', 500))
+# Сколько последних сегментов хранится; более старые удаляются при создании нового (0 — без ограничения)
+RESULTS_MAX_SEGMENTS = int(os.getenv('RESULTS_MAX_SEGMENTS', 100))
+
+_STOP = object()
+
+# Положение записи в сегменте и её краткое описание для списка
+IndexEntry = namedtuple('IndexEntry', 'path offset length kind created_at title')
+
+
+# Хранилище результатов /retrieve и /generate: записи получают идентификатор сразу, а на диск
+# попадают из фонового потока пачками — дописыванием строк в JSONL-сегменты. Каждый процесс пишет
+# в свои сегменты (в имени есть pid), поэтому воркеры gunicorn не мешают друг другу.
+# Для чтения держится индекс id -> (сегмент, смещение, длина): при первом обращении сегменты просматриваются
+# целиком, дальше дочитываются только новые строки, а запись по id читается одним seek
+class ResultStore:
+    def __init__(self, directory=RESULTS_DIR, max_bytes=RESULTS_MAX_BYTES, flush_interval=RESULTS_FLUSH_INTERVAL,
+                 batch_size=RESULTS_BATCH_SIZE, max_segments=RESULTS_MAX_SEGMENTS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.written = 0
+        self.flushes = 0
+        self.failed = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._pending = {}
+        self._segment = None
+        self._lock = threading.Lock()
+        # Индекс записей на диске: id -> IndexEntry, порядок строк в каждом сегменте и сколько байт уже прочитано
+        self._index = {}
+        self._segment_ids = {}
+        self._scanned = {}
+        self._index_lock = threading.Lock()
+
+    # Очередь и поток создаются при первой записи в каждом процессе (после fork поток не наследуется)
+    def _ensure_worker(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            self._pending = {}
+            self._segment = None
+            self._thread = threading.Thread(target=self._run, name='result-store', daemon=True)
+            self._thread.start()
+
+    def put(self, kind, data):
+        self._ensure_worker()
+        record = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'created_at': time.time(),
+            'data': data
+        }
+        # До сброса на диск запись доступна из памяти
+        self._pending[record['id']] = record
+        self._queue.put(record)
+        return record['id']
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            while record is not _STOP and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(record)
+            stop = batch[-1] is _STOP
+            records = [record for record in batch if record is not _STOP]
+            if records:
+                try:
+                    self._write(records)
+                except OSError as e:
+                    self.failed += len(records)
+                    print(f"Failed to persist {len(records)} results: {e}", flush=True)
+            for record in records:
+                self._pending.pop(record['id'], None)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, records):
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+        # Сегмент мог быть удалён (вручную или ограничением числа сегментов) — тогда начинается новый
+        if self._segment is not None and not os.path.exists(self._segment):
+            self._segment = None
+        if self._segment is None or os.path.getsize(self._segment) + len(data) > self.max_bytes:
+            os.makedirs(self.directory, exist_ok=True)
+            self._segment = os.path.join(self.directory, f"results-{time.time_ns()}-{os.getpid()}.jsonl")
+            self._remove_old_segments()
+        # Одна запись write на пачку: строки сегмента никогда не перемешиваются
+        with open(self._segment, 'ab') as file:
+            file.write(data)
+        self.written += len(records)
+        self.flushes += 1
+
+    # Ожидание, пока все поставленные в очередь записи окажутся на диске
+    def flush(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self, timeout=5):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    @staticmethod
+    def _segment_pid(path):
+        try:
+            return int(os.path.basename(path)[:-len('.jsonl')].rsplit('-', 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    @staticmethod
+    def _pid_alive(pid):
+        if os.name != 'posix':
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True
+        return True
+
+    # Удаление самых старых сегментов сверх max_segments (включая сегменты других процессов).
+    # Последний сегмент каждого живого процесса не удаляется: в него ещё идёт запись
+    def _remove_old_segments(self):
+        if self.max_segments <= 0:
+            return
+        segments = [path for path in self._segments() if path != self._segment]
+        # Сегменты отсортированы от новых к старым: первый встреченный сегмент процесса — последний
+        newest = {}
+        for path in segments:
+            newest.setdefault(self._segment_pid(path), path)
+        live = {path for pid, path in newest.items() if pid not in (None, os.getpid()) and self._pid_alive(pid)}
+        old = [path for path in segments[self.max_segments - 1:] if path not in live]
+        for path in old:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _segments(self):
+        # Имена сегментов начинаются с времени создания в наносекундах: сортировка даёт хронологию
+        return sorted(glob.glob(os.path.join(self.directory, 'results-*.jsonl')), reverse=True)
+
+    # Дочитывание индекса: новые строки всех сегментов (в том числе чужих процессов) и забывание удалённых
+    def _refresh(self):
+        with self._index_lock:
+            segments = self._segments()
+            for path in set(self._segment_ids) - set(segments):
+                for record_id in self._segment_ids.pop(path):
+                    self._index.pop(record_id, None)
+                self._scanned.pop(path, None)
+            for path in segments:
+                scanned = self._scanned.get(path, 0)
+                try:
+                    if os.path.getsize(path) == scanned:
+                        continue
+                    with open(path, 'rb') as file:
+                        file.seek(scanned)
+                        data = file.read()
+                except OSError:
+                    continue
+                # Незаконченная последняя строка (пачка ещё дописывается) будет прочитана в следующий раз
+                end = data.rfind(b'\n') + 1
+                ids = self._segment_ids.setdefault(path, [])
+                offset = scanned
+                for line in data[:end].splitlines(keepends=True):
+                    record = json.loads(line)
+                    self._index[record['id']] = IndexEntry(
+                        path, offset, len(line), record['kind'], record['created_at'],
+                        record['data'].get('request', {}).get('title')
+                    )
+                    ids.append(record['id'])
+                    offset += len(line)
+                self._scanned[path] = scanned + end
+            return segments
+
+    @staticmethod
+    def _read_record(entry):
+        try:
+            with open(entry.path, 'rb') as file:
+                file.seek(entry.offset)
+                return json.loads(file.read(entry.length))
+        except OSError:
+            return None
+
+    def get(self, record_id):
+        record = self._pending.get(record_id)
+        if record is not None:
+            return record
+        entry = self._index.get(record_id)
+        if entry is None:
+            self._refresh()
+            entry = self._index.get(record_id)
+        return self._read_record(entry) if entry is not None else None
+
+    # Краткие описания записей от новых к старым: сначала ещё не сброшенные, затем сегменты от последнего
+    # к первому. Описания берутся из индекса, сами записи не читаются
+    def _iter_summaries(self):
+        pending = sorted(list(self._pending.values()), key=lambda record: record['created_at'], reverse=True)
+        seen = {record['id'] for record in pending}
+        for record in pending:
+            yield IndexEntry(None, None, None, record['kind'], record['created_at'],
+                             record['data'].get('request', {}).get('title')), record['id']
+        for path in self._refresh():
+            for record_id in reversed(self._segment_ids.get(path, [])):
+                entry = self._index.get(record_id)
+                if entry is not None and record_id not in seen:
+                    yield entry, record_id
+
+    def list(self, limit=50, offset=0, kind=None):
+        summaries = ((entry, record_id) for entry, record_id in self._iter_summaries()
+                     if not kind or entry.kind == kind)
+        return [
+            {
+                'id': record_id,
+                'kind': entry.kind,
+                'created_at': entry.created_at,
+                'title': entry.title
+            }
+            for entry, record_id in itertools.islice(summaries, offset, offset + limit)
+        ]
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'written': self.written,
+            'flushes': self.flushes,
+            'failed': self.failed,
+            'segments': len(self._segments()),
+            'indexed': len(self._index)
+        }
+
+
+result_store = ResultStore()
+atexit.register(result_store.close)
@@ -0,0 +1,331 @@
+import glob
+import json
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+
+# Поля и их веса, как в multi_match запроса к Elasticsearch
+FIELD_BOOSTS = {
+    'description': 2,
+    'description_lemmatized': 2,
+    'sections': 1.5,
+    'sections_lemmatized': 1.5,
+    'topics': 1,
+    'topics_lemmatized': 1
+}
+# Совпадает с token_pattern TfidfVectorizer по умолчанию
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+# Файлы TF-IDF индекса (имя -> расширение); на диске к имени добавляется поколение сборки
+INDEX_FILES = {
+    'data': 'npy',
+    'indices': 'npy',
+    'indptr': 'npy',
+    'idf': 'npy',
+    'vocabulary': 'json',
+    'documents': 'json'
+}
+
+
+# Запрос к Elasticsearch; без lemmatized поиск идёт только по исходным полям
+# (индекс с морфологией на стороне Elasticsearch не содержит лемматизированных копий)
+def search_body(query, size, lemmatized=True):
+    body = {
+        "query": {
+            "function_score": {
+                "query": {
+                    "multi_match": {
+                        "query": query,
+                        "fields": [
+                            # "title_lemmatized^3",
+                            # "title^3",
+                            "description_lemmatized^2",
+                            "description^2",
+                            "sections_lemmatized^1.5",
+                            "sections^1.5",
+                            "topics_lemmatized",
+                            "topics"
+                        ],
+                        "type": "best_fields"
+                    }
+                },
+                "functions": [
+                    # {
+                    #     "filter": {"match": {"title_lemmatized": query}},
+                    #     "weight": 3
+                    # },
+                    {
+                        "filter": {"match": {"description": query}},
+                        "weight": 2
+                    },
+                    {
+                        "filter": {"match": {"description_lemmatized": query}},
+                        "weight": 2
+                    },
+                    {
+                        "filter": {"match": {"sections": query}},
+                        "weight": 2
+                    },
+                    {
+                        "filter": {"match": {"sections_lemmatized": query}},
+                        "weight": 1.5
+                    },
+                    {
+                        "filter": {"match": {"topics": query}},
+                        "weight": 1
+                    },
+                    {
+                        "filter": {"match": {"topics_lemmatized": query}},
+                        "weight": 1
+                    }
+                ],
+                "score_mode": "sum",  # Определяет, как итоговые счета функций должны быть суммированы
+                "boost_mode": "multiply"  # Определяет, как итоговый функциональный счет влияет на счет запроса
+            }
+        },
+        "_source": ["title", "description", "sections", "topics"],  # Указываем, какие поля нужно вернуть
+        "size": size,  # Количество возвращаемых документов
+        "explain": True  # Включаем объяснение для каждого документа
+    }
+    if not lemmatized:
+        function_score = body["query"]["function_score"]
+        multi_match = function_score["query"]["multi_match"]
+        multi_match["fields"] = [field for field in multi_match["fields"] if "_lemmatized" not in field]
+        function_score["functions"] = [
+            function for function in function_score["functions"]
+            if not any(field.endswith("_lemmatized") for field in function["filter"]["match"])
+        ]
+    return body
+
+
+def parse_hits(response):
+    results = []
+    for hit in response['hits']['hits']:
+        result_info = {
+            'title': hit['_source']['title'],
+            'description': hit['_source']['description'],
+            'sections': hit['_source']['sections'],
+            'topics': hit['_source']['topics'],
+            'score': hit['_score'],
+            'explanation': hit.get('_explanation', {})  # Добавляем объяснение в вывод, если доступно
+        }
+        results.append(result_info)
+    return results
+
+
+# Поиск через Elasticsearch по алиасу индекса курсов
+class ElasticsearchRetriever:
+    name = 'elasticsearch'
+
+    def __init__(self, get_es, index, lemmatized_fields=True):
+        self.get_es = get_es
+        self.index = index
+        self.lemmatized_fields = lemmatized_fields
+
+    def search(self, query, size):
+        response = self.get_es().search(index=self.index, body=search_body(query, size, self.lemmatized_fields))
+        return parse_hits(response)
+
+    def search_many(self, queries, size):
+        if not queries:
+            return []
+        body = []
+        for query in queries:
+            body.append({"index": self.index})
+            body.append(search_body(query, size, self.lemmatized_fields))
+        results = []
+        for query, response in zip(queries, self.get_es().msearch(body=body)['responses']):
+            if 'error' in response:
+                raise RuntimeError(f"Search failed for {query!r}: {response['error']}")
+            results.append(parse_hits(response))
+        return results
+
+    # Поколение индекса: имя версионированного индекса и метка из _meta, обновляемая при синхронизации
+    def generation(self):
+        mappings = self.get_es().indices.get_mapping(index=self.index)
+        return ','.join(
+            f"{index}:{mapping['mappings'].get('_meta', {}).get('generation', '')}"
+            for index, mapping in sorted(mappings.items())
+        )
+
+
+def _field_text(value):
+    if isinstance(value, list):
+        return ' '.join(item for item in value if item)
+    return value or ''
+
+
+# Одна загруженная сборка TF-IDF индекса
+TfidfIndex = namedtuple('TfidfIndex', 'weights idf vocabulary documents')
+
+
+# Поиск в памяти процесса по разреженной TF-IDF матрице курсов.
+# Матрица хранится на диске в виде .npy массивов CSR и открывается через mmap
+class TfidfRetriever:
+    name = 'tfidf'
+
+    def __init__(self, path):
+        self.path = path
+        self._loaded_mtime = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def build(courses, path, stop_words=None):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        documents = []
+        field_texts = {field: [] for field in FIELD_BOOSTS}
+        for course_id, data in courses:
+            documents.append({
+                'id': str(course_id),
+                'title': data['title'],
+                'description': data['description'],
+                'sections': data['sections'],
+                'topics': data['topics']
+            })
+            for field in FIELD_BOOSTS:
+                field_texts[field].append(_field_text(data.get(field)))
+
+        vectorizer = TfidfVectorizer(token_pattern=TOKEN_PATTERN.pattern, stop_words=stop_words)
+        vectorizer.fit(text for texts in field_texts.values() for text in texts)
+        # Взвешенная сумма нормированных векторов полей: один вектор на курс
+        weights = None
+        for field, boost in FIELD_BOOSTS.items():
+            field_matrix = vectorizer.transform(field_texts[field]) * boost
+            weights = field_matrix if weights is None else weights + field_matrix
+        weights = sparse.csr_matrix(weights, dtype=np.float32)
+
+        # Файлы каждой сборки получают суффикс поколения, а meta.json ссылается на них: читатели держат
+        # файлы прошлой сборки через mmap, поэтому перезаписывать их на месте нельзя (SIGBUS, смешанные сборки)
+        os.makedirs(path, exist_ok=True)
+        generation = str(time.time_ns())
+        files = {name: f'{name}-{generation}.{extension}' for name, extension in INDEX_FILES.items()}
+        np.save(os.path.join(path, files['data']), weights.data)
+        np.save(os.path.join(path, files['indices']), weights.indices)
+        np.save(os.path.join(path, files['indptr']), weights.indptr)
+        np.save(os.path.join(path, files['idf']), vectorizer.idf_.astype(np.float32))
+        vocabulary = {term: int(column) for term, column in vectorizer.vocabulary_.items()}
+        with open(os.path.join(path, files['vocabulary']), 'w', encoding='utf-8') as file:
+            json.dump(vocabulary, file, ensure_ascii=False)
+        with open(os.path.join(path, files['documents']), 'w', encoding='utf-8') as file:
+            json.dump(documents, file, ensure_ascii=False)
+        # meta.json заменяется атомарно и последним: по нему читатели определяют, что индекс обновился
+        previous = TfidfRetriever._meta_generation(path)
+        meta = {'shape': list(weights.shape), 'generation': generation, 'files': files}
+        tmp_path = os.path.join(path, 'meta.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, os.path.join(path, 'meta.json'))
+        TfidfRetriever._remove_stale(path, keep={generation, previous})
+        return {'backend': 'tfidf', 'path': path, 'documents': weights.shape[0], 'terms': weights.shape[1]}
+
+    @staticmethod
+    def _meta_generation(path):
+        try:
+            with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as file:
+                return json.load(file)['generation']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    # Удаление файлов старых сборок; предыдущая остаётся для читателей, успевших прочитать прежний meta.json
+    @staticmethod
+    def _remove_stale(path, keep):
+        for name, extension in INDEX_FILES.items():
+            for file_path in glob.glob(os.path.join(path, f'{name}*.{extension}')):
+                suffix = os.path.basename(file_path)[len(name):-len(extension) - 1]
+                if suffix.lstrip('-') not in keep:
+                    try:
+                        os.remove(file_path)
+                    except OSError:
+                        pass
+
+    def _read_meta(self):
+        with open(os.path.join(self.path, 'meta.json'), 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    # Загрузка (или перезагрузка после перестройки) индекса с диска; изменение видно по mtime meta.json.
+    # Все части сборки заменяются одним присваиванием, поэтому поиск не смешивает словарь одной сборки с матрицей другой
+    def _ensure_loaded(self):
+        mtime = os.stat(os.path.join(self.path, 'meta.json')).st_mtime_ns
+        if mtime == self._loaded_mtime:
+            return self._index
+        with self._lock:
+            if mtime == self._loaded_mtime:
+                return self._index
+            meta = self._read_meta()
+            # Индексы, построенные до появления поколений в именах, ссылаются на файлы без суффикса
+            files = meta.get('files') or {name: f'{name}.{extension}' for name, extension in INDEX_FILES.items()}
+            file_path = lambda name: os.path.join(self.path, files[name])
+            load = lambda name: np.load(file_path(name), mmap_mode='r')
+            weights = sparse.csr_matrix(
+                (load('data'), load('indices'), load('indptr')),
+                shape=tuple(meta['shape']), copy=False
+            )
+            idf = np.load(file_path('idf'))
+            with open(file_path('vocabulary'), 'r', encoding='utf-8') as file:
+                vocabulary = json.load(file)
+            with open(file_path('documents'), 'r', encoding='utf-8') as file:
+                documents = json.load(file)
+            self._index = TfidfIndex(weights, idf, vocabulary, documents)
+            self._loaded_mtime = mtime
+            return self._index
+
+    # Матрица запросов с той же схемой TF-IDF, что и при построении (tf * idf, L2-нормировка)
+    @staticmethod
+    def _vectorize(index, queries):
+        rows, columns, values = [], [], []
+        for row, query in enumerate(queries):
+            counts = {}
+            for token in TOKEN_PATTERN.findall(query.lower()):
+                column = index.vocabulary.get(token)
+                if column is not None:
+                    counts[column] = counts.get(column, 0) + 1
+            for column, count in counts.items():
+                rows.append(row)
+                columns.append(column)
+                values.append(count * index.idf[column])
+        matrix = sparse.csr_matrix(
+            (np.asarray(values, dtype=np.float32), (rows, columns)),
+            shape=(len(queries), len(index.vocabulary))
+        )
+        norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A.ravel()
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms) @ matrix
+
+    def search_many(self, queries, size):
+        if not queries:
+            return []
+        index = self._ensure_loaded()
+        scores = (self._vectorize(index, queries) @ index.weights.T).toarray()
+        results = []
+        for row in scores:
+            count = min(size, int(np.count_nonzero(row)))
+            if count == 0:
+                results.append([])
+                continue
+            top = np.argpartition(-row, count - 1)[:count]
+            top = top[np.argsort(-row[top])]
+            results.append([self._hit(index.documents[position], float(row[position])) for position in top])
+        return results
+
+    def search(self, query, size):
+        return self.search_many([query], size)[0]
+
+    @staticmethod
+    def _hit(document, score):
+        return {
+            'title': document['title'],
+            'description': document['description'],
+            'sections': document['sections'],
+            'topics': document['topics'],
+            'score': score,
+            'explanation': {'value': score, 'description': 'weighted tf-idf cosine over course fields'}
+        }
+
+    def generation(self):
+        return self._read_meta()['generation']
@@ -0,0 +1,56 @@
+import threading
+
+from .metrics import singleflight_calls
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Объединение одинаковых одновременных вызовов: первый вызов с данным ключом выполняет функцию,
+# остальные, пришедшие до его завершения, ждут и получают тот же результат (или то же исключение;
+# если ведущий прерван, например по таймауту gevent, ведомые выполняют вызов заново).
+# Результаты не кэшируются: после завершения вызова следующий с тем же ключом выполнится заново
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            singleflight_calls.inc(flight=self.name, role='follower')
+            call.event.wait()
+            # Ведущего прервали извне (не ошибка самой функции) — ведомый повторяет вызов сам
+            if call.error is not None and not isinstance(call.error, Exception):
+                return self.do(key, fn, *args, **kwargs)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        singleflight_calls.inc(flight=self.name, role='leader')
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        # BaseException: ведущего могут прервать GreenletExit, gevent.Timeout или KeyboardInterrupt,
+        # и ведомые не должны получить None вместо результата
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
@@ -1,69 +1,181 @@
-import nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from langdetect import detect
+import argparse
+import json
+import math
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+
 import numpy as np
-from pymorphy2 import MorphAnalyzer
-import string
-from sklearn.feature_extraction.text import TfidfVectorizer
 
-# Предварительная загрузка необходимых данных
-nltk.download('stopwords')
-nltk.download('punkt')
+from .lemmatizer import lemma_cache, lemmatize_word
+
+STOPWORDS_PATH = os.getenv(
+    'STOPWORDS_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mined_stopwords.json')
+)
+
+WORD_RE = re.compile(r"[^\W\d_]{2,}")
+CYRILLIC_RE = re.compile(r"[а-яё]")
+LATIN_RE = re.compile(r"[a-z]")
+# Доля букв одного алфавита, при которой язык определяется без langdetect
+SCRIPT_RATIO = 0.8
+
+
+@lru_cache(maxsize=1)
+def _nltk_stopwords():
+    import nltk
+    from nltk.corpus import stopwords
+
+    nltk.download('stopwords', quiet=True)
+    return frozenset(stopwords.words('russian')), frozenset(stopwords.words('english'))
+
+
+@lru_cache(maxsize=100000)
+def _langdetect(text):
+    from langdetect import LangDetectException, detect
+
+    try:
+        return detect(text)
+    except LangDetectException:
+        return 'ru'  # По умолчанию используем русский, если язык не определен
+
 
 # Класс для предварительной обработки текстов
 class TextPreprocessor:
     def __init__(self):
-        self.russian_stopwords = stopwords.words('russian')
-        self.english_stopwords = stopwords.words('english')
-        self.morph_ru = MorphAnalyzer()
+        self.russian_stopwords, self.english_stopwords = _nltk_stopwords()
+
+    # Язык определяется по алфавиту; langdetect (с кэшем) вызывается только для смешанных текстов
+    @staticmethod
+    def detect_language(text):
+        lowered = text.lower()
+        cyrillic = len(CYRILLIC_RE.findall(lowered))
+        latin = len(LATIN_RE.findall(lowered))
+        letters = cyrillic + latin
+        if not letters:
+            return 'ru'
+        if cyrillic / letters >= SCRIPT_RATIO:
+            return 'ru'
+        if latin / letters >= SCRIPT_RATIO:
+            return 'en'
+        return _langdetect(text)
+
+    def preprocess_tokens(self, text):
+        lang = self.detect_language(text)
+        words = WORD_RE.findall(text.lower())
+        # Лемматизация через общий кэш лемм и фильтрация стоп-слов
+        if lang == 'ru':
+            return [lemmatize_word(word) for word in words if word not in self.russian_stopwords]
+        return [word for word in words if word not in self.english_stopwords]
+
+    def preprocess_batch(self, texts):
+        return [self.preprocess_tokens(text) for text in texts]
 
     def preprocess_text(self, text):
-        try:
-            lang = detect(text)
-        except:
-            lang = 'ru'  # По умолчанию используем русский, если язык не определен
+        return " ".join(self.preprocess_tokens(text))
 
-        stop_words = self.russian_stopwords if lang == 'ru' else self.english_stopwords
 
-        # Удаление знаков пунктуации
-        text = text.translate(str.maketrans('', '', string.punctuation))
+# Инкрементальный подсчёт документной частоты: в памяти только разреженный словарь термин -> число документов
+class DocumentFrequencies:
+    def __init__(self):
+        self.df = Counter()
+        self.documents = 0
 
-        # Токенизация
-        words = word_tokenize(text, language='russian' if lang == 'ru' else 'english')
+    def update(self, token_lists):
+        for tokens in token_lists:
+            self.df.update(set(tokens))
+            self.documents += 1
 
-        # Лемматизация и фильтрация стоп-слов
-        if lang == 'ru':
-            words = [self.morph_ru.parse(word)[0].normal_form for word in words if word not in stop_words]
-        else:
-            words = [word.lower() for word in words if word.lower() not in stop_words]
+    # Сглаженный IDF, как в TfidfVectorizer: ln((1 + n) / (1 + df)) + 1
+    def idf(self):
+        words = list(self.df)
+        df = np.fromiter((self.df[word] for word in words), dtype=np.float64, count=len(words))
+        return words, np.log((1 + self.documents) / (1 + df)) + 1
 
-        return " ".join(words)
 
 # Класс для вычисления стоп-слов на основе IDF
 class IDFStopWords:
-    def __init__(self, documents):
-        self.vectorizer = TfidfVectorizer()
-        self.vectorizer.fit_transform(documents)
+    def __init__(self, documents=()):
+        self.frequencies = DocumentFrequencies()
+        self.frequencies.update(document.split() for document in documents)
 
-    def get_stop_words(self):
-        idf_values = self.vectorizer.idf_
-        words = self.vectorizer.get_feature_names_out()
+    # Без порога берутся слова с IDF не выше медианы; с min_df_ratio — слова, встречающиеся
+    # не менее чем в этой доле документов, в порядке убывания частоты
+    def get_stop_words(self, min_df_ratio=None, max_words=None):
+        words, idf_values = self.frequencies.idf()
+        if not words:
+            return []
+        sorted_indices = np.argsort(idf_values, kind='stable')
+        if min_df_ratio is None:
+            idf_threshold = np.median(idf_values)
+        else:
+            documents = self.frequencies.documents
+            idf_threshold = math.log((1 + documents) / (1 + min_df_ratio * documents)) + 1
+        stop_words = [words[idx] for idx in sorted_indices if idf_values[idx] <= idf_threshold]
+        return stop_words[:max_words] if max_words else stop_words
 
-        sorted_indices = np.argsort(idf_values)
-        sorted_words = [words[idx] for idx in sorted_indices]
-        sorted_idfs = [idf_values[idx] for idx in sorted_indices]
 
-        idf_threshold = np.median(idf_values)
+def course_document(course):
+    parts = [course['title'], course['description']] + course['sections'] + course['topics']
+    return ' '.join(part for part in parts if part)
 
-        stop_words = [word for word, idf in zip(sorted_words, sorted_idfs) if idf <= idf_threshold]
-        return stop_words
 
-# Использование классов
-if __name__ == "__main__":
+# Потоковый подбор стоп-слов: документы обрабатываются порциями, в памяти держатся только частоты
+def mine_stopwords(courses, min_df_ratio=0.3, max_words=200, batch_size=500, progress=None):
     preprocessor = TextPreprocessor()
-    documents = [preprocessor.preprocess_text(f"{course[2]} {course[3]} {course[4]}") for course in courses]
+    calculator = IDFStopWords()
+    batch = []
+    for _, course in courses:
+        batch.append(course_document(course))
+        if len(batch) >= batch_size:
+            calculator.frequencies.update(preprocessor.preprocess_batch(batch))
+            batch = []
+            if progress:
+                progress('mined', calculator.frequencies.documents)
+    if batch:
+        calculator.frequencies.update(preprocessor.preprocess_batch(batch))
+    if progress:
+        progress('mined', calculator.frequencies.documents)
+    return calculator.get_stop_words(min_df_ratio=min_df_ratio, max_words=max_words)
+
+
+def save_stopwords(words, path=STOPWORDS_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(words, file, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
 
-    idf_calculator = IDFStopWords(documents)
-    new_stop_words = idf_calculator.get_stop_words()
+def load_stopwords(path=STOPWORDS_PATH):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+# Использование: python -m modules.stopwords [--min-df 0.3] [--max-words 200]
+# Результат попадает в фильтр subject_stop при следующей полной переиндексации
+def main(argv=None):
+    from .rag_system import fetch_courses, iter_courses
+
+    parser = argparse.ArgumentParser(description="Подбор стоп-слов по документной частоте в корпусе курсов")
+    parser.add_argument('--output', default=STOPWORDS_PATH)
+    parser.add_argument('--min-df', type=float, default=0.3, help="минимальная доля документов со словом")
+    parser.add_argument('--max-words', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    new_stop_words = mine_stopwords(
+        iter_courses(fetch_courses()), args.min_df, args.max_words, args.batch_size,
+        progress=lambda stage, count: print(f"{stage}: {count}", flush=True)
+    )
+    save_stopwords(new_stop_words, args.output)
+    lemma_cache.save()
     print("Proposed new stop words:", new_stop_words)
+    print(f"Saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Тесты импортируют modules и benchmarks так же, как приложение, запущенное из каталога app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
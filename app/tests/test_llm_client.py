@@ -0,0 +1,26 @@
+import email.utils
+import time
+
+import pytest
+
+from modules.llm_client import LLM_BACKOFF_BASE, LLMClient
+
+
+class _Response:
+    def __init__(self, retry_after):
+        self.headers = {'Retry-After': retry_after} if retry_after is not None else {}
+
+
+def test_retry_after_seconds():
+    assert LLMClient._retry_delay(_Response('3'), 0) == 3
+
+
+def test_retry_after_http_date():
+    date = email.utils.formatdate(time.time() + 10, usegmt=True)
+    assert LLMClient._retry_delay(_Response(date), 0) == pytest.approx(10, abs=1.5)
+
+
+@pytest.mark.parametrize('retry_after', ['soon', 'Wed, 99 Foo 2024', ''])
+def test_unparseable_retry_after_falls_back_to_backoff(retry_after):
+    delay = LLMClient._retry_delay(_Response(retry_after), 1)
+    assert LLM_BACKOFF_BASE <= delay <= 2 * LLM_BACKOFF_BASE
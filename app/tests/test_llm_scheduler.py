@@ -0,0 +1,163 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmarks.fake_llm import FakeLLMServer
+from modules.llm_client import LLMClient, LLMError
+from modules.llm_scheduler import LLMScheduler, SchedulerTimeout, TokenBucket, priority
+
+PROMPT = 'Разработай структуру курса «Компьютерные сети»'
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(600)
+    now = bucket.updated
+    assert bucket.wait_time(600, now) == 0
+    bucket.take(600)
+    # 600 в минуту — 10 единиц в секунду
+    assert bucket.wait_time(1, now) == pytest.approx(0.1)
+    assert bucket.wait_time(1, now + 0.1) == pytest.approx(0)
+    # Запрос больше ёмкости ждёт полного ведра, а не бесконечно
+    assert bucket.wait_time(10000, now + 0.1) == pytest.approx(59.9)
+
+
+def test_token_bucket_give_is_capped():
+    bucket = TokenBucket(100)
+    bucket.take(30)
+    bucket.give(50)
+    assert bucket.level == 100
+    bucket.give(-40)
+    assert bucket.level == 60
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(0)
+    bucket.take(10 ** 6)
+    assert bucket.wait_time(10 ** 6, time.monotonic()) == 0
+
+
+def test_set_shards_splits_limits():
+    scheduler = LLMScheduler(rpm=600, tpm=90000)
+    scheduler.set_shards(3)
+    assert scheduler.stats()['rpm_limit'] == 200
+    assert scheduler.stats()['tpm_limit'] == 30000
+
+
+def test_interactive_requests_go_first():
+    scheduler = LLMScheduler(rpm=600, tpm=0, timeout=5)
+    scheduler._requests.level = 0
+    granted = []
+
+    def acquire(name):
+        scheduler.acquire(1, name)
+        granted.append(name)
+
+    with ThreadPoolExecutor(4) as executor:
+        for _ in range(3):
+            executor.submit(acquire, 'bulk')
+        while scheduler.stats()['queued']['bulk'] < 3:
+            time.sleep(0.001)
+        executor.submit(acquire, 'interactive')
+    assert granted == ['interactive', 'bulk', 'bulk', 'bulk']
+
+
+def test_priority_context_sets_queue():
+    scheduler = LLMScheduler()
+    with priority('bulk'):
+        assert scheduler.acquire(10).priority == 'bulk'
+    assert scheduler.acquire(10).priority == 'interactive'
+
+
+def test_penalize_pauses_all_requests():
+    scheduler = LLMScheduler(rpm=0, tpm=0)
+    scheduler.penalize(0.3)
+    assert scheduler.stats()['paused_for'] > 0
+    started = time.monotonic()
+    scheduler.acquire(1)
+    assert time.monotonic() - started >= 0.29
+
+
+def test_settle_refunds_and_charges_by_usage():
+    scheduler = LLMScheduler(rpm=0, tpm=6000, completion_tokens=800)
+    reservation = scheduler.acquire(3000)
+    assert scheduler._tokens.level == pytest.approx(3000, abs=1)
+    scheduler.settle(reservation, 1000, completion_tokens=200)
+    assert scheduler._tokens.level == pytest.approx(5000, abs=1)
+    # Оценка длины ответа сдвигается к фактической
+    assert scheduler.completion_tokens == pytest.approx(800 + 0.2 * (200 - 800))
+    # Повторный пересчёт того же резерва ничего не меняет
+    scheduler.settle(reservation, 0)
+    assert scheduler._tokens.level == pytest.approx(5000, abs=1)
+
+    overrun = scheduler.acquire(1000)
+    scheduler.settle(overrun, 3000)
+    assert scheduler._tokens.level == pytest.approx(2000, abs=1)
+
+
+def test_queue_timeout():
+    scheduler = LLMScheduler(rpm=60, tpm=0, timeout=0.2)
+    scheduler._requests.level = 0
+    with pytest.raises(SchedulerTimeout):
+        scheduler.acquire(1)
+    assert scheduler.stats()['queued'] == {'interactive': 0, 'bulk': 0}
+
+
+def test_client_pauses_after_429():
+    server = FakeLLMServer(latency=0, rpm_limit=600).start()
+    try:
+        server._budget['requests'] = 0
+        scheduler = LLMScheduler(rpm=0, tpm=0)
+        client = LLMClient('test', base_url=server.base_url, max_retries=3, scheduler=scheduler)
+        assert client.complete(PROMPT, 'test-model', 0.7)
+        assert server.rate_limited == 1
+        # Retry-After округляется сервером до целых секунд, и на это время приостановлены все запросы процесса
+        assert scheduler._paused_until > time.monotonic() - 1
+    finally:
+        server.stop()
+
+
+# Сервер и планировщик начинают с пустыми вёдрами и одинаковым лимитом rpm
+def _drained(rpm):
+    server = FakeLLMServer(latency=0, rpm_limit=rpm).start()
+    server._budget['requests'] = 0
+    scheduler = LLMScheduler(rpm=rpm, tpm=0, timeout=10)
+    scheduler._requests.level = 0
+    return server, scheduler
+
+
+def _complete_all(client, count):
+    def call(_):
+        try:
+            return client.complete(PROMPT, 'test-model', 0.7)
+        except LLMError:
+            return None
+
+    with ThreadPoolExecutor(count) as executor:
+        return list(executor.map(call, range(count)))
+
+
+def test_scheduler_keeps_within_rate_limit():
+    server, scheduler = _drained(600)
+    try:
+        client = LLMClient('test', base_url=server.base_url, max_retries=0, scheduler=scheduler)
+        started = time.monotonic()
+        results = _complete_all(client, 15)
+        elapsed = time.monotonic() - started
+        assert all(results)
+        assert server.rate_limited == 0
+        assert server.requests == 15
+        assert elapsed >= 1.3
+    finally:
+        server.stop()
+
+
+def test_without_scheduler_requests_are_rate_limited():
+    server, _ = _drained(600)
+    try:
+        client = LLMClient('test', base_url=server.base_url, max_retries=0)
+        results = _complete_all(client, 15)
+        assert server.rate_limited > 0
+        assert results.count(None) == server.rate_limited
+    finally:
+        server.stop()
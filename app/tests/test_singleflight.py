@@ -0,0 +1,120 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmarks.fake_llm import FakeLLMServer
+from modules.llm_client import LLMClient
+from modules.metrics import singleflight_calls
+from modules.singleflight import SingleFlight
+
+
+def _calls(flight, role):
+    return singleflight_calls._values.get((flight, role), 0)
+
+
+# Запуск count одинаковых вызовов; ведущий держит вызов, пока не соберутся все ведомые
+def _run_together(flight, fn, count=8):
+    release = threading.Event()
+    started = threading.Event()
+
+    def call():
+        started.set()
+        release.wait(5)
+        return fn()
+
+    with ThreadPoolExecutor(count) as executor:
+        futures = [executor.submit(flight.do, 'key', call) for _ in range(count)]
+        assert started.wait(5)
+        deadline = time.monotonic() + 5
+        while _calls(flight.name, 'follower') < count - 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        return futures
+
+
+def test_followers_get_leader_result():
+    flight = SingleFlight('test-result')
+    runs = []
+
+    def fn():
+        runs.append(1)
+        return object()
+
+    futures = _run_together(flight, fn)
+    results = [future.result() for future in futures]
+    assert len(runs) == 1
+    assert all(result is results[0] for result in results)
+    assert _calls('test-result', 'leader') == 1
+    assert _calls('test-result', 'follower') == len(futures) - 1
+    assert flight.in_flight() == 0
+
+
+def test_followers_get_leader_error():
+    flight = SingleFlight('test-error')
+    error = ValueError('upstream failed')
+
+    def fn():
+        raise error
+
+    futures = _run_together(flight, fn)
+    for future in futures:
+        with pytest.raises(ValueError) as raised:
+            future.result()
+        assert raised.value is error
+    assert flight.in_flight() == 0
+
+
+def test_result_is_not_cached():
+    flight = SingleFlight('test-sequential')
+    runs = []
+    assert flight.do('key', lambda: runs.append(1) or len(runs)) == 1
+    assert flight.do('key', lambda: runs.append(1) or len(runs)) == 2
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight('test-keys')
+    assert [flight.do(key, lambda key=key: key * 2) for key in (1, 2, 3)] == [2, 4, 6]
+
+
+def test_identical_llm_calls_reach_upstream_once():
+    server = FakeLLMServer(latency=0.3).start()
+    try:
+        client = LLMClient('test', base_url=server.base_url)
+        flight = SingleFlight('test-llm')
+        prompt = 'Разработай структуру курса «Компьютерные сети»'
+        with ThreadPoolExecutor(20) as executor:
+            results = list(executor.map(
+                lambda _: flight.do(prompt, client.complete, prompt, 'test-model', 0.7), range(20)
+            ))
+        assert server.requests == 1
+        assert len(set(results)) == 1
+    finally:
+        server.stop()
+
+
+class _Interrupted(BaseException):
+    pass
+
+
+def test_followers_retry_when_leader_is_interrupted():
+    flight = SingleFlight('test-interrupted')
+    runs = []
+
+    def fn():
+        runs.append(1)
+        if len(runs) == 1:
+            raise _Interrupted()
+        return 'done'
+
+    futures = _run_together(flight, fn, count=4)
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append(future.result())
+        except _Interrupted:
+            outcomes.append('interrupted')
+    # Прерывание получает только ведущий; ведомые повторяют вызов вместо None в результате
+    assert sorted(outcomes) == ['done', 'done', 'done', 'interrupted']
+    assert flight.in_flight() == 0